@@ -0,0 +1,413 @@
+# Benchmark suite for FeatureTableConnection workloads
+#
+# Run from the top-level directory, e.g.
+#   python -m performance.Benchmark --rows 1000 --repeat 3 -o results.json
+#   python -m performance.Benchmark --rows 1000 --baseline results.json
+# By default tables are created in a temporary directory using the local
+# HDF5 backend, use --host to benchmark an OMERO server instead.
+
+import argparse
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from performance.SimulateData import simulate, simulateBatch, \
+    dict2description, dict2columns, mus
+from table_features.TableConnection import FeatureTableConnection, NDARRAY
+from table_features.Instrumentation import MemorySink
+
+
+# name: function(tc, config, timer)
+WORKLOADS = OrderedDict()
+
+def workload(name):
+    """
+    Decorator which registers a workload function
+    """
+    def register(f):
+        WORKLOADS[name] = f
+        return f
+    return register
+
+
+class Timer(object):
+    """
+    Records the latency and number of rows of each timed operation
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.rows = 0
+
+    def time(self, nrows, f, *args, **kwargs):
+        """
+        Time a single operation
+        @param nrows The number of rows processed by the operation
+        @param f The function to be called with args and kwargs
+        @return the result of f
+        """
+        t0 = time.time()
+        r = f(*args, **kwargs)
+        self.latencies.append(time.time() - t0)
+        self.rows += nrows
+        return r
+
+
+class Config(object):
+    """
+    Benchmark configuration, passed to each workload
+    """
+
+    def __init__(self, rows = 1000, repeat = 3, batch = 100, chunk = 100,
+                 lookups = 1000, delField = 0.8, seed = 0, localDir = None,
+                 host = None, user = None, passwd = None):
+        """
+        @param rows The number of rows in each table
+        @param repeat The number of times each workload is repeated
+        @param batch The number of rows in each bulk insert
+        @param chunk The number of rows in each read
+        @param lookups The number of id lookups
+        @param delField The probability of a null column in null-heavy data
+        @param seed The random seed
+        @param localDir The directory for the local backend
+        @param host The OMERO server, if set localDir is ignored
+        @param user The OMERO username
+        @param passwd The OMERO password
+        """
+        self.rows = rows
+        self.repeat = repeat
+        self.batch = batch
+        self.chunk = chunk
+        self.lookups = lookups
+        self.delField = delField
+        self.seed = seed
+        self.localDir = localDir
+        self.host = host
+        self.user = user
+        self.passwd = passwd
+
+    def connect(self, name):
+        """
+        Create a connection and a new empty table
+        """
+        tableName = '/benchmark-%s.h5' % name
+        if self.host:
+            tc = FeatureTableConnection(self.user, self.passwd, self.host,
+                                        tableName=tableName)
+        else:
+            tc = FeatureTableConnection(tableName=tableName,
+                                        localDir=self.localDir)
+        dummy = simulate(0, 0)
+        tc.createNewTable('id', dict2description(dummy['features']))
+        return tc
+
+
+def populate(tc, config, delField = 0.0):
+    """
+    Fill a table with config.rows simulated objects (not timed)
+    """
+    for i in xrange(0, config.rows, config.batch):
+        n = min(config.batch, config.rows - i)
+        batch = simulateBatch(n, i, delField, seed=[config.seed, i])
+        tc.addPartialData(batch.toColumns())
+
+
+@workload('insert')
+def insertSingle(tc, config, timer):
+    """
+    Insert objects one row at a time, as SimulateData.insert
+    """
+    for i in xrange(config.rows):
+        a = simulate(i, i % len(mus))
+        timer.time(1, tc.addPartialData, dict2columns(a['id'], a['features']))
+
+
+@workload('bulkInsert')
+def insertBulk(tc, config, timer):
+    """
+    Insert the same batch of objects repeatedly, as
+    SimulateData.insertBulkRepeat
+    """
+    acols = simulateBatch(config.batch, seed=config.seed).toColumns()
+    for i in xrange(0, config.rows, config.batch):
+        n = min(config.batch, config.rows - i)
+        if n < config.batch:
+            acols = simulateBatch(n, seed=config.seed).toColumns()
+        timer.time(n, tc.addPartialData, acols)
+
+
+@workload('scan')
+def scan(tc, config, timer):
+    """
+    Read the whole table in chunks, as SimulateData.readBulk
+    """
+    populate(tc, config)
+    colNumbers = range(len(tc.getHeaders()))
+    for i in xrange(0, config.rows, config.chunk):
+        stop = min(i + config.chunk, config.rows)
+        timer.time(stop - i, tc.readArray, colNumbers, i, stop)
+
+
+@workload('scanPipelined')
+def scanPipelined(tc, config, timer):
+    """
+    Read the whole table as numpy arrays with read-ahead
+    """
+    populate(tc, config)
+    colNumbers = range(len(tc.getHeaders()))
+    chunks = tc.iterChunks(colNumbers, chunk=config.chunk, result=NDARRAY)
+    for i in xrange(0, config.rows, config.chunk):
+        stop = min(i + config.chunk, config.rows)
+        timer.time(stop - i, next, chunks)
+
+
+@workload('subArray')
+def subArray(tc, config, timer):
+    """
+    Read random chunks of a few elements from a few columns
+    """
+    populate(tc, config)
+    headers = tc.getHeaders()
+    rng = random.Random(config.seed)
+    for i in xrange(0, config.rows, config.chunk):
+        cols = rng.sample(xrange(1, len(headers)), 4)
+        colArrayNumbers = dict((c, rng.sample(xrange(headers[c].size), 2))
+                               for c in cols)
+        colArrayNumbers[0] = []
+        start = rng.randint(0, max(config.rows - config.chunk, 0))
+        timer.time(config.chunk, tc.readSubArray, colArrayNumbers,
+                   start, start + config.chunk)
+
+
+@workload('idLookup')
+def idLookup(tc, config, timer):
+    """
+    Look up random object ids one at a time
+    """
+    populate(tc, config)
+    rng = random.Random(config.seed)
+    for i in xrange(config.lookups):
+        timer.time(1, tc.getRowId, rng.randint(0, config.rows - 1))
+
+
+@workload('nullHeavyInsert')
+def nullHeavyInsert(tc, config, timer):
+    """
+    Bulk insert objects in which most columns are null
+    """
+    for i in xrange(0, config.rows, config.batch):
+        n = min(config.batch, config.rows - i)
+        cols = simulateBatch(n, i, config.delField,
+                             seed=[config.seed, i]).toColumns()
+        timer.time(n, tc.addPartialData, cols)
+
+
+@workload('nullHeavyScan')
+def nullHeavyScan(tc, config, timer):
+    """
+    Read a table of objects in which most columns are null in chunks
+    """
+    populate(tc, config, config.delField)
+    colNumbers = range(len(tc.getHeaders()))
+    for i in xrange(0, config.rows, config.chunk):
+        stop = min(i + config.chunk, config.rows)
+        timer.time(stop - i, tc.readArray, colNumbers, i, stop)
+
+
+def percentile(values, p):
+    """
+    @return the p-th percentile of values, using linear interpolation
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    k = (len(values) - 1) * p / 100.0
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def peakRss():
+    """
+    @return the peak resident set size of this process in bytes
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+
+def runWorkload(name, config):
+    """
+    Run all repetitions of a single workload
+    @return a dictionary of results, calls holds the totals for each type
+    of remote table call, see Instrumentation.MemorySink
+    """
+    timer, calls = _repeatWorkload(name, config)
+    elapsed = sum(timer.latencies)
+    return OrderedDict([
+        ('operations', len(timer.latencies)),
+        ('rows', timer.rows),
+        ('seconds', elapsed),
+        ('throughput', timer.rows / elapsed if elapsed else None),
+        ('p50', percentile(timer.latencies, 50)),
+        ('p95', percentile(timer.latencies, 95)),
+        ('p99', percentile(timer.latencies, 99)),
+        ('peakRss', peakRss()),
+        ('calls', calls),
+        ])
+
+
+def _repeatWorkload(name, config):
+    """
+    Internal helper method, runs all repetitions of a workload on new tables
+    @return a 2-tuple (Timer, calls) holding the measurements and remote
+    call totals of all repetitions, table creation is not included
+    """
+    timer = Timer()
+    calls = MemorySink()
+    for r in xrange(config.repeat):
+        random.seed(config.seed + r)
+        tc = config.connect(name)
+        try:
+            tc.instrumentation.addSink(calls)
+            try:
+                WORKLOADS[name](tc, config, timer)
+            finally:
+                tc.instrumentation.removeSink(calls)
+                tc.deleteTable()
+        finally:
+            tc.close()
+
+    return timer, calls.snapshot()
+
+
+def run(names, config, isolate = True):
+    """
+    Run a set of workloads
+    @param names The names of the workloads
+    @param config A Config object
+    @param isolate If True run each workload in a new process so that peak
+    RSS is measured independently
+    @return a dictionary of results suitable for saving as JSON
+    """
+    results = OrderedDict()
+    for name in names:
+        if isolate:
+            pool = multiprocessing.Pool(1)
+            try:
+                results[name] = pool.apply(runWorkload, (name, config))
+            finally:
+                pool.terminate()
+        else:
+            results[name] = runWorkload(name, config)
+
+    metadata = OrderedDict([
+        ('date', datetime.utcnow().isoformat()),
+        ('host', platform.node()),
+        ('python', platform.python_version()),
+        ('backend', config.host or 'local'),
+        ('config', dict((k, v) for (k, v) in vars(config).iteritems()
+                        if k not in ('passwd', 'localDir'))),
+        ])
+    return OrderedDict([('metadata', metadata), ('workloads', results)])
+
+
+def compare(results, baseline, tolerance = 0.1):
+    """
+    Compare results against a baseline
+    @param results The results of run()
+    @param baseline The results of a previous run()
+    @param tolerance The fractional change which is treated as significant
+    @return a list of (workload, metric, baseline, current, ratio,
+    regression) for each metric
+    """
+    # metric: True if higher is better
+    metrics = [('throughput', True), ('p50', False), ('p95', False),
+               ('p99', False), ('peakRss', False)]
+    rows = []
+    for (name, r) in results['workloads'].iteritems():
+        b = baseline['workloads'].get(name)
+        if not b:
+            continue
+        for (m, higherIsBetter) in metrics:
+            if not b.get(m) or r.get(m) is None:
+                continue
+            ratio = r[m] / float(b[m])
+            if higherIsBetter:
+                regression = ratio < 1 - tolerance
+            else:
+                regression = ratio > 1 + tolerance
+            rows.append((name, m, b[m], r[m], ratio, regression))
+    return rows
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark FeatureTableConnection workloads')
+    parser.add_argument('workloads', nargs='*', default=WORKLOADS.keys(),
+                        help='Workloads to run: %s' % ', '.join(WORKLOADS))
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--batch', type=int, default=100)
+    parser.add_argument('--chunk', type=int, default=100)
+    parser.add_argument('--lookups', type=int, default=1000)
+    parser.add_argument('--delField', type=float, default=0.8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--local', help='Directory for the local backend')
+    parser.add_argument('--host', help='OMERO server')
+    parser.add_argument('--user', default='test1')
+    parser.add_argument('--passwd', default='test1')
+    parser.add_argument('-o', '--output', help='Save results to this file')
+    parser.add_argument('--baseline', help='Compare against saved results')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error('Unknown workload: %s' % name)
+
+    localDir = args.local
+    if not args.host and not localDir:
+        localDir = tempfile.mkdtemp()
+    config = Config(args.rows, args.repeat, args.batch, args.chunk,
+                    args.lookups, args.delField, args.seed, localDir,
+                    args.host, args.user, args.passwd)
+    try:
+        results = run(args.workloads, config)
+    finally:
+        if localDir and not args.local:
+            shutil.rmtree(localDir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = 0
+        print '%-14s %-10s %12s %12s %7s' % (
+            'workload', 'metric', 'baseline', 'current', 'ratio')
+        for (name, m, b, r, ratio, regression) in compare(
+            results, baseline, args.tolerance):
+            print '%-14s %-10s %12.4g %12.4g %7.2f%s' % (
+                name, m, b, r, ratio, ' REGRESSION' if regression else '')
+            regressions += regression
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
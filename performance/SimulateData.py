@@ -1,6 +1,9 @@
 # Generate some data for performance testing
 from random import normalvariate, random
 from datetime import datetime
+import multiprocessing
+import numpy
+import os
 
 
 
@@ -9,6 +12,9 @@ sigma = 4
 mus = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
 ns = [10, 20, 30, 40]
 #ns = [1,1,1,1]
+# Default timestamp of all objects in generated shards, fixed so that the
+# same seed always gives the same dataset
+shardEpoch = datetime(2013, 1, 1)
 
 def randN(mu, n):
     return [normalvariate(mu, sigma) for i in xrange(n)]
@@ -63,6 +69,213 @@ def simulate(id, mu, delField = 0.0):
     return r
 
 
+def featureLayout(groups = ['t0', 't1', 't2', 't3'],
+                  names = ['f0', 'f1', 'f2', 'f3'], sizes = ns, levels = 2,
+                  sep = sep, root = ''):
+    """
+    Describe the feature hierarchy generated by simulate(): a set of
+    features at the top level, and a copy under every group at each of
+    levels nested levels of groups.
+    The defaults give the simulate() column names, for mongotest.py use
+    groups t1-t4 and names f1-f4, for tablestest.py additionally use
+    sep='/' and root='/'
+    @return a list of (path, components, size) where path is root followed
+    by the components joined by sep
+    """
+    layout = []
+    prefixes = [()]
+    for level in xrange(levels + 1):
+        for pre in prefixes:
+            for (name, size) in zip(names, sizes):
+                components = pre + (name,)
+                layout.append((root + sep.join(components), components, size))
+        prefixes = [pre + (g,) for pre in prefixes for g in groups]
+    return layout
+
+
+class SimulatedBatch(object):
+    """
+    A batch of simulated objects in columnar form, see simulateBatch()
+    """
+
+    def __init__(self, ids, timestamps, features, valid, layout):
+        """
+        @param ids A 1-D int64 array of object ids
+        @param timestamps A 1-D datetime64 array
+        @param features A dictionary mapping feature paths to (N, size)
+        float64 arrays
+        @param valid A dictionary mapping feature paths to 1-D boolean arrays
+        which are False where the feature was deleted
+        @param layout The featureLayout() used to generate the batch
+        """
+        self.ids = ids
+        self.timestamps = timestamps
+        self.features = features
+        self.valid = valid
+        self.layout = layout
+
+    def __len__(self):
+        return len(self.ids)
+
+    def toDicts(self):
+        """
+        @return a list of dicts in the form returned by simulate()
+        """
+        ts = self.timestamps.astype(datetime)
+        rows = [{} for i in xrange(len(self))]
+        for (path, components, size) in self.layout:
+            a = self.features[path].tolist()
+            for i in numpy.flatnonzero(self.valid[path]):
+                rows[i][path] = a[i]
+        return [{'id': id, 'timestamp': t, 'features': f}
+                for (id, t, f) in zip(self.ids.tolist(), ts, rows)]
+
+    def toColumns(self):
+        """
+        @return a list of columns in the form returned by multDict2columns(),
+        deleted features are []
+        """
+        from omero.grid import LongColumn, DoubleArrayColumn
+        cols = [LongColumn('id', '', self.ids.tolist())]
+        for (path, components, size) in self.layout:
+            v = self.features[path].tolist()
+            for i in numpy.flatnonzero(~self.valid[path]):
+                v[i] = []
+            cols.append(DoubleArrayColumn(path, '', size, v))
+        return cols
+
+    def toArrays(self):
+        """
+        @return a 2-tuple (arrays, valid) of arguments for
+        FeatureTableConnection.addArrays
+        """
+        arrays = dict(self.features)
+        arrays['id'] = self.ids
+        return arrays, dict(self.valid)
+
+    def toDocuments(self):
+        """
+        @return a list of nested documents in the form generated by
+        mongotest.simulate(), use a layout with groups t1-t4 and names f1-f4
+        to get the same field names
+        """
+        ts = self.timestamps.astype(datetime)
+        docs = [{'_id': id, 'timestamp': t}
+                for (id, t) in zip(self.ids.tolist(), ts)]
+        for (path, components, size) in self.layout:
+            a = self.features[path].tolist()
+            for i in numpy.flatnonzero(self.valid[path]):
+                d = docs[i]
+                for c in components[:-1]:
+                    d = d.setdefault(c, {})
+                d[components[-1]] = a[i]
+        return docs
+
+
+def simulateBatch(n, start = 0, delField = 0.0, seed = None, layout = None,
+                  timestamp = None):
+    """
+    Generate n objects with the same distribution as simulate() using
+    vectorised numpy operations. Object i has id start + i and mean
+    mus[id % len(mus)], as in insert().
+    @param n The number of objects
+    @param start The first id
+    @param delField The probability of each feature of an object being
+    deleted
+    @param seed A seed (int or sequence of ints) or a numpy RandomState,
+    the same seed always gives the same values
+    @param layout A featureLayout(), defaults to the simulate() layout
+    @param timestamp The timestamp of all objects, defaults to now
+    @return a SimulatedBatch
+    """
+    if isinstance(seed, numpy.random.RandomState):
+        rng = seed
+    else:
+        rng = numpy.random.RandomState(seed)
+    if layout is None:
+        layout = featureLayout()
+    if timestamp is None:
+        timestamp = datetime.utcnow()
+
+    ids = numpy.arange(start, start + n, dtype=numpy.int64)
+    mu = numpy.asarray(mus, dtype=numpy.float64)[ids % len(mus)]
+    timestamps = numpy.repeat(numpy.datetime64(timestamp, 'us'), n)
+
+    features = {}
+    for (path, components, size) in layout:
+        features[path] = rng.normal(0.0, sigma, (n, size)) + mu[:, None]
+
+    # Generate validity after all features so that the values for a seed
+    # do not depend on delField
+    valid = {}
+    for (path, components, size) in layout:
+        if delField:
+            valid[path] = rng.random_sample(n) >= delField
+            features[path][~valid[path]] = 0.0
+        else:
+            valid[path] = numpy.ones(n, dtype=bool)
+
+    return SimulatedBatch(ids, timestamps, features, valid, layout)
+
+
+def generateShards(directory, n, shardSize = 100000, seed = 0,
+                   processes = None, delField = 0.0, layout = None,
+                   format = 'npz', timestamp = None, compress = False):
+    """
+    Generate a large simulated dataset in parallel and write it to archive
+    files (see table_features.FeatureArchive) which can be bulk loaded
+    with FeatureTableConnection.addArrays.
+    Shard i holds ids [i * shardSize, (i + 1) * shardSize) and is generated
+    from the seed [seed, i], so the same arguments always give byte
+    identical files regardless of the number of processes.
+    @param directory The output directory, will be created if necessary
+    @param n The total number of objects
+    @param shardSize The number of objects in each shard
+    @param seed The dataset seed
+    @param processes The number of worker processes, default is the number
+    of CPUs, if 1 shards are generated in this process
+    @param delField See simulateBatch()
+    @param layout See simulateBatch()
+    @param format 'npz' or 'h5'
+    @param timestamp The timestamp of all objects, defaults to shardEpoch
+    @param compress If True compress the shards
+    @return a list of shard file names in id order
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if timestamp is None:
+        timestamp = shardEpoch
+
+    tasks = []
+    for (i, start) in enumerate(xrange(0, n, shardSize)):
+        path = os.path.join(directory, 'shard-%05d.%s' % (i, format))
+        tasks.append((path, min(shardSize, n - start), start, delField,
+                      [seed, i], layout, timestamp, compress))
+
+    if processes == 1:
+        return map(_generateShard, tasks)
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_generateShard, tasks, chunksize=1)
+    finally:
+        pool.terminate()
+
+
+def _generateShard(task):
+    """
+    Internal helper method, generates and writes a single shard
+    @return the shard file name
+    """
+    from table_features.FeatureArchive import writeArchive
+    (path, n, start, delField, seed, layout, timestamp, compress) = task
+    batch = simulateBatch(n, start, delField, seed, layout, timestamp)
+    arrays, valid = batch.toArrays()
+    writeArchive(path, arrays, valid, timestamps=batch.timestamps,
+                 compress=compress)
+    return path
+
+
+
 
 
 
@@ -108,8 +321,9 @@ def multDict2columns(sims, missing = []):
     features = concatDictValues(features, missing)
 
     from omero.grid import LongColumn, DoubleArrayColumn
+    # The first value may be missing so use the longest to get the size
     cols = [LongColumn('id', '', ids)] + \
-        [DoubleArrayColumn(k, '', len(v[0]), v)
+        [DoubleArrayColumn(k, '', max(len(x) for x in v), v)
          for (k, v) in features.iteritems()]
     return cols
 
@@ -123,9 +337,14 @@ def columns2dict(cols, nrows = 1):
 
 
 def setup(user = 'test1', passwd = 'test1', host = 'localhost',
-          tableName = '/test.h5', new = False):
+          tableName = '/test.h5', new = False, localDir = None):
+    """
+    Connect to a feature table, if localDir is set the local HDF5 backend
+    is used instead of a server
+    """
     from table_features.TableConnection import FeatureTableConnection
-    tc = FeatureTableConnection(user, passwd, host, tableName)
+    tc = FeatureTableConnection(user, passwd, host, tableName = tableName,
+                                localDir = localDir)
 
     if new:
         dummy = simulate(0, 0)
@@ -165,6 +384,16 @@ def insert(tc, n, check, keep):
         return k
 
 
+def insertBuffered(tc, n, maxRows = 1000):
+    """
+    Insert simulated objects one at a time through a FeatureTableWriter, so
+    that rows are added to the table in batches of maxRows
+    """
+    from table_features.FeatureTableWriter import FeatureTableWriter
+    with FeatureTableWriter(tc, maxRows) as writer:
+        insert(writer, n, False, False)
+
+
 def insertBulkRepeat(tc, nr, n, check, keep):
     """
     Bulk insert multiple rows
@@ -197,9 +426,11 @@ def insertBulkRepeat(tc, nr, n, check, keep):
         return a
 
 
-def readBulk(tc, nr, skip = None):
+def readBulk(tc, nr, skip = None, prefetch = 0):
     """
     Do a bulk read of the whole table, ignore data
+    If prefetch is set the table is streamed with tc.iterChunks in chunks
+    of nr rows, reading up to prefetch chunks ahead (skip is ignored)
     """
 
     if not skip:
@@ -208,6 +439,14 @@ def readBulk(tc, nr, skip = None):
     start = datetime.now()
     stopwatch = []
     colNumbers = range(len(tc.getHeaders()))
+    if prefetch:
+        from table_features.TableConnection import NDARRAY
+        for (i, cols) in tc.iterChunks(colNumbers, chunk=nr, result=NDARRAY,
+                                       prefetch=prefetch):
+            stopwatch.append((datetime.now() - start).total_seconds())
+            print stopwatch[-1]
+        return stopwatch
+
     for i in xrange(0, tc.getNumberOfRows(), skip):
         tc.readArray(colNumbers, i, i + nr)
         stopwatch.append((datetime.now() - start).total_seconds())
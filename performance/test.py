@@ -0,0 +1,89 @@
+from performance.SimulateData import *
+import hashlib
+import io
+import numpy
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestSimulateBatch(unittest.TestCase):
+
+    def assertBatchEqual(self, a, b):
+        self.assertTrue(numpy.array_equal(a.ids, b.ids))
+        self.assertTrue(numpy.array_equal(a.timestamps, b.timestamps))
+        self.assertEquals(sorted(a.features.keys()), sorted(b.features.keys()))
+        for k in a.features:
+            self.assertTrue(numpy.array_equal(a.features[k], b.features[k]))
+            self.assertTrue(numpy.array_equal(a.valid[k], b.valid[k]))
+
+    def testSeed(self):
+        ts = datetime(2013, 1, 1)
+        a = simulateBatch(100, 10, 0.3, seed=[1, 2], timestamp=ts)
+        b = simulateBatch(100, 10, 0.3, seed=[1, 2], timestamp=ts)
+        self.assertBatchEqual(a, b)
+        self.assertEquals(a.ids.tolist(), range(10, 110))
+
+        c = simulateBatch(100, 10, 0.3, seed=[1, 3], timestamp=ts)
+        self.assertFalse(numpy.array_equal(a.features['t0_f0'],
+                                           c.features['t0_f0']))
+
+
+    def testColumnsArrays(self):
+        batch = simulateBatch(50, 0, 0.5, seed=0)
+        cols = batch.toColumns()
+        arrays, valid = batch.toArrays()
+
+        self.assertEquals(cols[0].name, 'id')
+        self.assertEquals(cols[0].values, arrays['id'].tolist())
+        self.assertEquals([c.name for c in cols[1:]],
+                          [path for (path, c, s) in batch.layout])
+        for col in cols[1:]:
+            self.assertEquals(col.size, arrays[col.name].shape[1])
+            self.assertTrue(0 < valid[col.name].sum() < 50)
+            for (v, a, ok) in zip(col.values, arrays[col.name],
+                                  valid[col.name]):
+                self.assertEquals(v, a.tolist() if ok else [])
+
+
+class TestGenerateShards(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def readShards(self, paths):
+        digests = []
+        for path in paths:
+            with io.open(path, 'rb') as f:
+                digests.append(hashlib.sha1(f.read()).hexdigest())
+        return digests
+
+    def testDeterministic(self):
+        for format in ['npz', 'h5']:
+            for compress in [False, True]:
+                shards = []
+                for (run, processes) in enumerate([1, 2, 1]):
+                    d = os.path.join(self.tmpDir, '%s%d%d' % (
+                            format, compress, run))
+                    paths = generateShards(
+                        d, 250, 100, seed=3, processes=processes,
+                        delField=0.2, format=format, compress=compress)
+                    self.assertEquals([os.path.basename(p) for p in paths],
+                                      ['shard-%05d.%s' % (i, format)
+                                       for i in xrange(3)])
+                    shards.append(self.readShards(paths))
+                self.assertEquals(shards[0], shards[1])
+                self.assertEquals(shards[0], shards[2])
+
+        paths = generateShards(os.path.join(self.tmpDir, 'seed'), 250, 100,
+                               seed=4, processes=1, delField=0.2,
+                               format='h5', compress=True)
+        self.assertNotEquals(self.readShards(paths)[0], shards[0][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#
+#
+from collections import OrderedDict
+
+
+class BlockCache(object):
+    """
+    A memory-bounded least-recently-used cache of blocks of rows of
+    individual columns, see FeatureTableConnection.enableBlockCache.
+
+    Rows are divided into aligned blocks of blockSize rows, and each entry
+    holds a FeatureArray with the values of one column for one block. Since
+    rows can only be appended to a table complete blocks never change, but
+    the last incomplete block of the table must be discarded when the number
+    of rows changes.
+    """
+
+    def __init__(self, maxBytes, blockSize):
+        """
+        @param maxBytes The maximum size of the cached arrays
+        @param blockSize The number of rows in each block
+        """
+        self.maxBytes = maxBytes
+        self.blockSize = blockSize
+        self.nrows = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.clear()
+
+    def clear(self):
+        """
+        Discard all entries, the counters are not reset
+        """
+        # (column number, block number): (FeatureArray, bytes)
+        self._entries = OrderedDict()
+        self._partial = set()
+        self._bytes = 0
+        self.nrows = None
+
+    def setRows(self, nrows):
+        """
+        Update the number of rows in the table, discarding incomplete blocks
+        if it has changed
+        @param nrows The number of rows in the table
+        """
+        if nrows != self.nrows:
+            self.invalidatePartial()
+            self.nrows = nrows
+
+    def invalidatePartial(self):
+        """
+        Discard all incomplete blocks
+        """
+        for key in self._partial:
+            self._bytes -= self._entries.pop(key)[1]
+        self._partial = set()
+
+    def get(self, key):
+        """
+        @param key A (column number, block number) tuple
+        @return the cached FeatureArray or None
+        """
+        try:
+            entry = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, a):
+        """
+        Add or replace an entry, evicting the least recently used entries if
+        the cache is full
+        @param key A (column number, block number) tuple
+        @param a A FeatureArray holding the rows of the block
+        """
+        nbytes = a.values.nbytes + a.valid.nbytes
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (a, nbytes)
+        self._bytes += nbytes
+        if len(a.valid) < self.blockSize:
+            self._partial.add(key)
+        else:
+            self._partial.discard(key)
+
+        while self._bytes > self.maxBytes and self._entries:
+            oldest, (x, n) = self._entries.popitem(last=False)
+            self._bytes -= n
+            self._partial.discard(oldest)
+            self.evictions += 1
+
+    def stats(self):
+        """
+        @return a dictionary of counters and the current size of the cache
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'blocks': len(self._entries),
+            'bytes': self._bytes,
+            'maxBytes': self.maxBytes,
+            }
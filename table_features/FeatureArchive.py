@@ -0,0 +1,596 @@
+#
+#
+"""
+Read and write feature data in numpy .npz or HDF5 archive files, in the
+form accepted by FeatureTableConnection.addArrays, so that data can be
+generated or exported once and bulk loaded later.
+
+An archive holds an id column, optional timestamps, and for each feature
+column an (N, size) float64 array and a 1-D boolean validity array. The
+format is chosen by the file extension (.npz, .h5 or .hdf5). Columns are
+stored as c0, c1, ... and v0, v1, ... with their names and sizes stored as
+JSON, since feature names may not be valid file or node names.
+
+Large archives can be written incrementally with ArchiveWriter, see
+FeatureTableConnection.exportArchive.
+
+HDF5 files without a header are read as feature trees, as written by
+mongo-test/tablestest.py. In tables mode every table of scalar columns,
+and in earray mode every 2-D array, is a feature column named after its
+path with '/' replaced by TREE_SEP, and a row in which every value is NaN
+is null. In matrix mode the feature columns are slices of the /matrix
+array given by the /features table, and nulls are given by /valid. Ids
+are read from a 1-D /id array if present, otherwise they are the row
+numbers starting from 1. Files containing any other nodes are rejected.
+"""
+
+import io
+import json
+import os
+import zipfile
+import numpy
+import tables
+from TableConnection import TableConnectionError
+
+
+NPZ = 'npz'
+HDF5 = 'hdf5'
+
+# Timestamps are stored as microseconds since the epoch
+TIMESTAMP_UNIT = 'datetime64[us]'
+
+# Replaces '/' in the paths of arrays in feature tree files
+TREE_SEP = '_'
+
+
+def archiveFormat(path):
+    """
+    @return NPZ or HDF5 depending on the extension of path
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.npz':
+        return NPZ
+    if ext in ('.h5', '.hdf5'):
+        return HDF5
+    raise TableConnectionError('Unknown archive format: %s' % path)
+
+
+def writeArchive(path, arrays, valid = None, idColName = 'id',
+                 timestamps = None, compress = False):
+    """
+    Write a new archive, overwriting any existing file
+    @param path The file name, the extension determines the format
+    @param arrays A dictionary mapping column names to arrays as for
+    FeatureTableConnection.addArrays, must include idColName
+    @param valid An optional dictionary mapping column names to 1-D boolean
+    arrays, columns without an entry are valid in every row
+    @param idColName The name of the id column
+    @param timestamps An optional 1-D datetime64 array
+    @param compress If True compress the data
+    """
+    ids, names, values, validity, ts = _checkArrays(
+        arrays, valid, idColName, timestamps)
+    columns = [(idColName, None)] + [(n, values[n].shape[1]) for n in names]
+    w = ArchiveWriter(path, columns, ts is not None, compress,
+                      expectedRows=len(ids))
+    try:
+        w.append(arrays, valid, timestamps)
+    finally:
+        w.close()
+
+
+def readArchive(path, start = None, stop = None):
+    """
+    Read an archive
+    @param path The file name
+    @param start The first row to be read, HDF5 archives are read
+    partially, npz archives are read in full and sliced
+    @param stop The last + 1 row to be read
+    @return a 3-tuple (arrays, valid, timestamps) where arrays and valid can
+    be passed to FeatureTableConnection.addArrays, and timestamps is a
+    datetime64 array or None
+    """
+    if archiveFormat(path) == NPZ:
+        f = numpy.load(path)
+        try:
+            header = json.loads(str(f['header']))
+            read = lambda key: f[key][start:stop]
+            return _fromStored(header, read)
+        finally:
+            f.close()
+
+    h = tables.openFile(path, 'r')
+    try:
+        if 'header' not in h.root._v_attrs:
+            return _readTree(h, start, stop)
+        header = json.loads(h.root._v_attrs.header)
+        read = lambda key: h.getNode('/', key).read(start, stop)
+        return _fromStored(header, read)
+    finally:
+        h.close()
+
+
+def archiveColumns(path):
+    """
+    @return a list of (name, size) of the columns in an archive, the first
+    is the id column with size None
+    """
+    if archiveFormat(path) == NPZ:
+        f = numpy.load(path)
+        try:
+            header = json.loads(str(f['header']))
+        finally:
+            f.close()
+    else:
+        h = tables.openFile(path, 'r')
+        try:
+            if 'header' not in h.root._v_attrs:
+                return [('id', None)] + [
+                    (name, size) for (name, size, rows, read) in
+                    _treeColumns(h)]
+            header = json.loads(h.root._v_attrs.header)
+        finally:
+            h.close()
+    return [tuple(c) for c in header['columns']]
+
+
+def archiveRows(path):
+    """
+    @return the number of rows in an archive
+    """
+    if archiveFormat(path) == NPZ:
+        f = numpy.load(path)
+        try:
+            return len(f['id'])
+        finally:
+            f.close()
+
+    h = tables.openFile(path, 'r')
+    try:
+        if 'header' in h.root._v_attrs:
+            return h.root.id.nrows
+        return _treeRows(h, _treeColumns(h))
+    finally:
+        h.close()
+
+
+class ArchiveWriter(object):
+    """
+    Writes an archive in chunks of rows.
+
+    HDF5 archives are appended to on disk, so an interrupted write can be
+    resumed: the header records the table row corresponding to the first
+    archived row, and rows() gives the number of rows already written. npz
+    archives can't be appended to, so the rows are held in memory and the
+    file is only written by close().
+    """
+
+    def __init__(self, path, columns, timestamps = False, compress = False,
+                 resume = False, start = 0, expectedRows = 10000):
+        """
+        @param path The file name, the extension determines the format
+        @param columns A list of (name, size) for each column, the first is
+        the id column with size None, see archiveColumns
+        @param timestamps If True every chunk must include timestamps
+        @param compress If True compress the data
+        @param resume If True and an HDF5 archive with the same columns
+        exists append to it, otherwise any existing file is overwritten
+        @param start The table row corresponding to the first archived row,
+        ignored if an existing archive is resumed
+        @param expectedRows The approximate total number of rows, used to
+        choose the HDF5 chunk size
+        """
+        self.path = path
+        self.columns = [(name, size) for (name, size) in columns]
+        self.idColName = self.columns[0][0]
+        self.timestamps = timestamps
+        self.format = archiveFormat(path)
+        self._h = None
+        self._chunks = []
+
+        if resume and os.path.exists(path):
+            if self.format != HDF5:
+                raise TableConnectionError(
+                    'Only HDF5 archives can be resumed: %s' % path)
+            self._resume()
+            return
+
+        self.start = start
+        self._rows = 0
+        if self.format == HDF5:
+            self._create(compress, expectedRows)
+        else:
+            self._compress = compress
+
+    def rows(self):
+        """
+        @return the number of rows written
+        """
+        return self._rows
+
+    def append(self, arrays, valid = None, timestamps = None):
+        """
+        Append rows to the archive
+        @param arrays A dictionary mapping every column name to an array, as
+        for writeArchive
+        @param valid An optional dictionary mapping column names to 1-D
+        boolean arrays
+        @param timestamps A 1-D datetime64 array, required if the archive
+        has timestamps
+        """
+        ids, names, values, validity, ts = _checkArrays(
+            arrays, valid, self.idColName, timestamps)
+        expected = sorted(name for (name, size) in self.columns[1:])
+        if names != expected:
+            raise TableConnectionError(
+                'Columns %s do not match archive columns %s' %
+                (names, expected))
+        for (name, size) in self.columns[1:]:
+            if values[name].shape[1] != size:
+                raise TableConnectionError(
+                    'Expected size %d for column %s, got %d' %
+                    (size, name, values[name].shape[1]))
+        if (ts is not None) != self.timestamps:
+            raise TableConnectionError(
+                'Timestamps must be provided if and only if the archive '
+                'has timestamps')
+
+        stored = [('id', ids)]
+        if ts is not None:
+            stored.append(('timestamp', ts))
+        for (n, (name, size)) in enumerate(self.columns[1:]):
+            stored.append(('c%d' % n, values[name]))
+            stored.append(('v%d' % n, validity[name]))
+
+        if self.format == HDF5:
+            for (key, a) in stored:
+                if key == 'timestamp':
+                    a = a.astype(numpy.int64)
+                self._h.getNode('/', key).append(a)
+            self._h.flush()
+        else:
+            self._chunks.append(stored)
+        self._rows += len(ids)
+
+    def close(self):
+        """
+        Finish writing the archive
+        """
+        if self.format == HDF5:
+            if self._h:
+                self._h.close()
+                self._h = None
+            return
+        if self._chunks is None:
+            return
+
+        data = {'header': numpy.array(self._header())}
+        if self._chunks:
+            for (i, (key, a)) in enumerate(self._chunks[0]):
+                data[key] = numpy.concatenate([c[i][1] for c in self._chunks])
+        else:
+            data['id'] = numpy.zeros(0, dtype=numpy.int64)
+            if self.timestamps:
+                data['timestamp'] = numpy.zeros(0, dtype=TIMESTAMP_UNIT)
+            for (n, (name, size)) in enumerate(self.columns[1:]):
+                data['c%d' % n] = numpy.zeros((0, size))
+                data['v%d' % n] = numpy.zeros(0, dtype=bool)
+        self._chunks = None
+        _savez(self.path, data, self._compress)
+
+    def _header(self):
+        """
+        Internal helper method, returns the JSON archive header
+        """
+        return json.dumps({'columns': self.columns,
+                           'timestamps': self.timestamps,
+                           'start': self.start})
+
+    def _create(self, compress, expectedRows):
+        """
+        Internal helper method, creates a new HDF5 archive with empty arrays
+        """
+        filters = tables.Filters(complevel=5, complib='zlib') if compress \
+            else None
+        expectedRows = max(expectedRows, 1)
+        h = self._h = tables.openFile(self.path, 'w')
+        h.root._v_attrs.header = self._header()
+
+        # Object times aren't recorded so that the same data always gives
+        # the same file, PyTables < 3.4 always records them
+        def create(key, atom, shape):
+            try:
+                h.createEArray('/', key, atom, shape, filters=filters,
+                               expectedrows=expectedRows, track_times=False)
+            except TypeError:
+                h.createEArray('/', key, atom, shape, filters=filters,
+                               expectedrows=expectedRows)
+        create('id', tables.Int64Atom(), (0,))
+        if self.timestamps:
+            create('timestamp', tables.Int64Atom(), (0,))
+        for (n, (name, size)) in enumerate(self.columns[1:]):
+            create('c%d' % n, tables.Float64Atom(), (0, size))
+            create('v%d' % n, tables.BoolAtom(), (0,))
+
+    def _resume(self):
+        """
+        Internal helper method, opens an existing HDF5 archive for appending
+        and discards any rows which were only partially written
+        """
+        invalid = TableConnectionError(
+            'Archive %s is not a resumable feature archive' % self.path)
+        try:
+            h = self._h = tables.openFile(self.path, 'a')
+        except (IOError, tables.HDF5ExtError):
+            raise invalid
+        try:
+            try:
+                header = json.loads(h.root._v_attrs.header)
+                columns = [tuple(c) for c in header['columns']]
+                timestamps = header['timestamps']
+            except (AttributeError, KeyError, TypeError, ValueError):
+                raise invalid
+            if columns != self.columns or timestamps != self.timestamps:
+                raise TableConnectionError(
+                    'Archive %s has different columns' % self.path)
+            self.start = header.get('start', 0)
+            try:
+                nodes = [h.getNode('/', key) for key in
+                         self._keys(len(columns) - 1)]
+            except tables.NoSuchNodeError:
+                raise invalid
+            self._rows = min(node.nrows for node in nodes)
+            for node in nodes:
+                if node.nrows > self._rows:
+                    node.truncate(self._rows)
+        except Exception:
+            self.close()
+            raise
+
+    def _keys(self, nColumns):
+        """
+        Internal helper method, returns the names of all stored arrays
+        """
+        keys = ['id']
+        if self.timestamps:
+            keys.append('timestamp')
+        for n in xrange(nColumns):
+            keys.extend(['c%d' % n, 'v%d' % n])
+        return keys
+
+
+def _savez(path, data, compress):
+    """
+    Internal helper method, writes an npz file like numpy.savez but with the
+    arrays in sorted order and a fixed modification time, so that the same
+    data always gives the same file
+    """
+    mode = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    z = zipfile.ZipFile(path, 'w', mode, allowZip64=True)
+    try:
+        for key in sorted(data):
+            info = zipfile.ZipInfo(key + '.npy', (1980, 1, 1, 0, 0, 0))
+            info.compress_type = mode
+            buf = io.BytesIO()
+            numpy.lib.format.write_array(buf, numpy.asanyarray(data[key]))
+            z.writestr(info, buf.getvalue())
+    finally:
+        z.close()
+
+
+def _checkArrays(arrays, valid, idColName, timestamps):
+    """
+    Internal helper method, converts and checks the arguments of
+    writeArchive
+    @return a 5-tuple (ids, names, values, validity, timestamps)
+    """
+    if valid is None:
+        valid = {}
+    try:
+        ids = numpy.asarray(arrays[idColName], dtype=numpy.int64)
+    except KeyError:
+        raise TableConnectionError(
+            "First column (%s) must be provided" % idColName)
+    if ids.ndim != 1:
+        raise TableConnectionError(
+            "Expected 1-D array for column %s" % idColName)
+    nRows = len(ids)
+
+    unexpected = set(valid.keys()).difference(arrays.keys())
+    if unexpected:
+        raise TableConnectionError(
+            "Validity without data: %s" % sorted(unexpected))
+
+    names = sorted(k for k in arrays.keys() if k != idColName)
+    values = {}
+    validity = {}
+    for name in names:
+        a = numpy.asarray(arrays[name], dtype=numpy.float64)
+        if a.ndim != 2 or a.shape[0] != nRows:
+            raise TableConnectionError(
+                "Expected (%d, size) array for column %s, got %s" %
+                (nRows, name, a.shape))
+        v = valid.get(name)
+        if v is None:
+            v = numpy.ones(nRows, dtype=bool)
+        else:
+            v = numpy.asarray(v, dtype=bool)
+            if v.shape != (nRows,):
+                raise TableConnectionError(
+                    "Expected %d validity values for column %s, got %s" %
+                    (nRows, name, v.shape))
+        values[name] = a
+        validity[name] = v
+
+    if timestamps is not None:
+        timestamps = numpy.asarray(timestamps).astype(TIMESTAMP_UNIT)
+        if timestamps.shape != (nRows,):
+            raise TableConnectionError(
+                "Expected %d timestamps, got %s" % (nRows, timestamps.shape))
+
+    return ids, names, values, validity, timestamps
+
+
+def _treeColumns(h):
+    """
+    Internal helper method, finds the feature columns in a feature tree file
+    @return a list of (column name, size, number of rows, read) sorted by
+    name, where read(start, stop) returns a 2-tuple (values, valid)
+    """
+    if '/matrix' in h:
+        return _matrixColumns(h)
+
+    def name(node):
+        return node._v_pathname.strip('/').replace('/', TREE_SEP)
+
+    columns = []
+    for node in h.walkNodes('/', 'Leaf'):
+        if node._v_pathname == '/id' and len(node.shape) == 1:
+            continue
+        if isinstance(node, tables.Table):
+            dtypes = [node.coldtypes[c] for c in node.colnames]
+            if not all(d.kind in 'fiu' and not d.shape for d in dtypes):
+                raise TableConnectionError(
+                    'Unsupported table %s in %s, expected scalar numeric '
+                    'columns' % (node._v_pathname, h.filename))
+            columns.append((name(node), len(dtypes), node.nrows,
+                            _tableReader(node)))
+        elif isinstance(node, tables.Array) and len(node.shape) == 2:
+            columns.append((name(node), node.shape[1], node.shape[0],
+                            _arrayReader(node)))
+        else:
+            raise TableConnectionError(
+                'Unsupported node %s in %s' % (node._v_pathname, h.filename))
+    return sorted(columns, key=lambda c: c[0])
+
+
+def _matrixColumns(h):
+    """
+    Internal helper method, finds the feature columns in a matrix mode
+    feature tree file, see _treeColumns
+    """
+    try:
+        matrix = h.root.matrix
+        valid = h.root.valid
+        features = h.root.features.read()
+    except tables.NoSuchNodeError as e:
+        raise TableConnectionError('Invalid matrix file %s: %s' %
+                                   (h.filename, e))
+    # The rows of the matrix and validity arrays which were last read, so
+    # that they are read once for all columns
+    cached = {}
+
+    def block(start, stop):
+        if cached.get('rows') != (start, stop):
+            cached['rows'] = (start, stop)
+            cached['matrix'] = matrix.read(start, stop)
+            cached['valid'] = valid.read(start, stop)
+        return cached['matrix'], cached['valid']
+
+    columns = []
+    for (i, f) in enumerate(features):
+        first, last = int(f['start']), int(f['stop'])
+        columns.append((f['path'].strip('/').replace('/', TREE_SEP),
+                        last - first, matrix.shape[0],
+                        _matrixReader(block, i, first, last)))
+    return sorted(columns, key=lambda c: c[0])
+
+
+def _matrixReader(block, i, first, last):
+    """
+    Internal helper method, returns a read function for the feature in
+    columns [first, last) of a matrix with validity column i, see
+    _treeColumns
+    @param block A function returning the matrix and validity rows
+    """
+    def read(start, stop):
+        matrix, valid = block(start, stop)
+        return matrix[:, first:last], valid[:, i]
+    return read
+
+
+def _arrayReader(a):
+    """
+    Internal helper method, returns a read function for a 2-D feature
+    array, see _treeColumns
+    """
+    def read(start, stop):
+        values = a.read(start, stop)
+        return values, _notNaN(values)
+    return read
+
+
+def _tableReader(t):
+    """
+    Internal helper method, returns a read function for a feature table
+    with one scalar column for each element, see _treeColumns
+    """
+    def read(start, stop):
+        rows = t.read(start, stop)
+        values = numpy.empty((len(rows), len(t.colnames)))
+        for (n, c) in enumerate(t.colnames):
+            values[:, n] = rows[c]
+        return values, _notNaN(values)
+    return read
+
+
+def _notNaN(values):
+    """
+    Internal helper method, returns a boolean array which is True for each
+    row of a 2-D array which has a value other than NaN
+    """
+    if values.shape[1]:
+        return ~numpy.isnan(values).all(axis=1)
+    return numpy.ones(len(values), dtype=bool)
+
+
+def _treeRows(h, columns):
+    """
+    Internal helper method, returns the number of rows in a feature tree
+    file, checking all columns have the same number of rows
+    """
+    rows = set(c[2] for c in columns)
+    if '/id' in h:
+        rows.add(h.root.id.shape[0])
+    if len(rows) > 1:
+        raise TableConnectionError(
+            'Arrays in %s have different numbers of rows' % h.filename)
+    return rows.pop() if rows else 0
+
+
+def _readTree(h, start, stop):
+    """
+    Internal helper method, reads a feature tree file, see readArchive
+    """
+    columns = _treeColumns(h)
+    start, stop, step = slice(start, stop).indices(_treeRows(h, columns))
+    if '/id' in h:
+        ids = h.root.id.read(start, stop)
+    else:
+        ids = numpy.arange(start + 1, max(start, stop) + 1, dtype=numpy.int64)
+
+    result = {'id': ids}
+    valid = {}
+    for (name, size, rows, read) in columns:
+        result[name], valid[name] = read(start, stop)
+    return result, valid, None
+
+
+def _fromStored(header, read):
+    """
+    Internal helper method, converts the stored arrays to the form returned
+    by readArchive
+    @param header The archive header
+    @param read A function which returns the stored array for a key
+    """
+    columns = header['columns']
+    idColName = columns[0][0]
+    arrays = {idColName: read('id')}
+    valid = {}
+    for (n, (name, size)) in enumerate(columns[1:]):
+        arrays[name] = read('c%d' % n)
+        valid[name] = read('v%d' % n)
+    timestamps = None
+    if header['timestamps']:
+        timestamps = read('timestamp').astype(TIMESTAMP_UNIT)
+    return arrays, valid, timestamps
@@ -0,0 +1,186 @@
+#
+#
+"""
+Bulk import of archive files into a feature table
+
+Archives (see FeatureArchive, including the feature tree files written by
+tablestest.py and the shards written by SimulateData.generateShards) are
+read, checked against the table schema and converted into null-filled
+arrays by a pool of worker processes. The batches are added to the table
+in file order by the calling process, so the table rows are in the same
+order as the files.
+
+If a checkpoint file is given an interrupted import can be resumed by
+calling importArchives again with the same arguments. The checkpoint
+records the number of table rows before the import started, and since
+each batch is added in a single call the number of rows imported so far
+is the difference from the current number of table rows.
+"""
+
+from collections import deque
+import json
+import logging
+import multiprocessing
+import numpy
+import os
+import time
+from FeatureArchive import NPZ, archiveFormat, archiveRows, readArchive
+from TableConnection import TableConnectionError
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+def importArchives(tc, paths, batch = 100000, processes = None,
+                   checkpoint = None, progress = None):
+    """
+    Append the rows of a list of archives to the open table of a
+    FeatureTableConnection
+    @param tc A FeatureTableConnection with an open table
+    @param paths A list of archive file names, imported in order
+    @param batch The maximum number of rows added in each call. HDF5
+    archives are read in batches, npz archives can only be read whole so
+    each is read by a single worker.
+    @param processes The number of worker processes, default is the number
+    of CPUs, if 1 the archives are read in this process
+    @param checkpoint An optional file name used to resume an interrupted
+    import, it is deleted when the import completes
+    @param progress An optional function called after each batch as
+    progress(rows imported, total rows)
+    @return the number of rows imported, including any imported before
+    the import was resumed
+    """
+    headers = tc.getHeaders()
+    idColName = headers[0].name
+    columns = dict((h.name, h.size) for h in headers[1:])
+
+    counts = [archiveRows(p) for p in paths]
+    total = sum(counts)
+    done = _readCheckpoint(tc, paths, checkpoint)[1]
+    if done > total:
+        raise TableConnectionError(
+            'Table has %d more rows than the import' % (done - total))
+    if done:
+        log.info('Resuming import at row %d of %d', done, total)
+
+    tasks = []
+    skip = done
+    for (p, n) in zip(paths, counts):
+        first = min(skip, n)
+        skip -= first
+        if first == n:
+            continue
+        step = n if archiveFormat(p) == NPZ else batch
+        for start in xrange(first, n, step):
+            tasks.append((p, start, min(start + step, n), idColName, columns))
+
+    t0 = time.time()
+    imported = 0
+    for (arrays, valid) in _convertAll(tasks, processes):
+        nRows = len(arrays[idColName])
+        for start in xrange(0, nRows, batch):
+            stop = start + batch
+            tc.addArrays(dict((k, a[start:stop]) for (k, a) in
+                              arrays.iteritems()),
+                         dict((k, v[start:stop]) for (k, v) in
+                              valid.iteritems()))
+        imported += nRows
+        done += nRows
+        seconds = time.time() - t0
+        log.info('Imported %d/%d rows (%.0f rows/s)', done, total,
+                 imported / seconds if seconds else 0)
+        if progress:
+            progress(done, total)
+
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return done
+
+
+def _readCheckpoint(tc, paths, checkpoint):
+    """
+    Internal helper method, reads or creates the checkpoint file
+    @return a 2-tuple (table rows before the import, rows already imported)
+    """
+    nRows = tc.getNumberOfRows()
+    if not checkpoint:
+        return nRows, 0
+
+    sources = [os.path.abspath(p) for p in paths]
+    if os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            state = json.load(f)
+        if state['sources'] != sources:
+            raise TableConnectionError(
+                'Checkpoint %s is for a different import' % checkpoint)
+        if nRows < state['tableRows']:
+            raise TableConnectionError(
+                'Table has fewer rows than when the import started')
+        return state['tableRows'], nRows - state['tableRows']
+
+    with open(checkpoint, 'w') as f:
+        json.dump({'sources': sources, 'tableRows': nRows}, f)
+    return nRows, 0
+
+
+def _convertAll(tasks, processes):
+    """
+    Internal helper method, converts tasks on a pool of worker processes,
+    keeping at most two batches per worker in memory
+    @return a generator of the results of _convert in task order
+    """
+    if processes == 1:
+        for task in tasks:
+            yield _convert(task)
+        return
+
+    maxPending = 2 * (processes or multiprocessing.cpu_count())
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = deque()
+        tasks = iter(tasks)
+        for task in tasks:
+            pending.append(pool.apply_async(_convert, (task,)))
+            if len(pending) >= maxPending:
+                break
+        while pending:
+            result = pending.popleft().get()
+            for task in tasks:
+                pending.append(pool.apply_async(_convert, (task,)))
+                break
+            yield result
+    finally:
+        pool.terminate()
+
+
+def _convert(task):
+    """
+    Internal helper method, reads a range of rows from an archive, checks
+    the columns match the table and zeroes null rows
+    @param task A tuple (path, start, stop, table id column name,
+    dictionary of table column names and sizes)
+    @return a 2-tuple (arrays, valid) for FeatureTableConnection.addArrays
+    """
+    (path, start, stop, idColName, columns) = task
+    stored, valid, timestamps = readArchive(path, start, stop)
+    storedId = [k for k in stored.keys() if k not in valid]
+    ids = numpy.asarray(stored.pop(storedId[0]), dtype=numpy.int64)
+
+    arrays = {idColName: ids}
+    for (name, a) in stored.iteritems():
+        try:
+            size = columns[name]
+        except KeyError:
+            raise TableConnectionError(
+                'Column %s in %s is not in the table' % (name, path))
+        a = numpy.asarray(a, dtype=numpy.float64)
+        if a.shape[1] != size:
+            raise TableConnectionError(
+                'Expected size %d for column %s in %s, got %d' %
+                (size, name, path, a.shape[1]))
+        v = numpy.asarray(valid[name], dtype=bool)
+        if not v.all():
+            a[~v] = 0.0
+        arrays[name] = a
+    return arrays, valid
@@ -0,0 +1,362 @@
+#
+#
+"""
+Predicates on feature table columns for FeatureTableConnection.query
+
+Predicates are built from Feature objects, for example:
+    (Feature('t2_t3_f3').all() > 1) & Feature('f0').mean().between(0, 5)
+    (Feature('f1')[3] <= 0) | Feature('f2').isNull()
+
+Array columns must be reduced before comparison:
+    all(), any(): the comparison holds for all/any elements of the array
+    mean(), min(), max(), sum(): the comparison applies to the reduced value
+    [i]: the comparison applies to element i
+Scalar columns such as the id column can be compared directly.
+
+Predicates use three-valued logic: a comparison on a null row is unknown,
+and a row only matches if the predicate is known to be true. So neither
+(f.all() > 1) nor ~(f.all() > 1) matches a row in which f is null, use
+isNull() and notNull() to test for nulls explicitly.
+"""
+
+import numpy
+import operator
+from TableConnection import TableConnectionError
+
+
+class Predicate(object):
+    """
+    Base class of all predicates, supports & (and), | (or) and ~ (not)
+    """
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def columns(self):
+        """
+        @return a set of the names of the columns used by this predicate
+        """
+        raise NotImplementedError()
+
+    def evaluate(self, arrays):
+        """
+        Evaluate the predicate on a block of rows
+        @param arrays A dictionary mapping column names to FeatureArrays
+        @return a 2-tuple of boolean arrays (true, false) indicating the rows
+        for which the predicate is known to be true or false, rows for
+        which both are False are unknown
+        """
+        raise NotImplementedError()
+
+    def evaluateBlocks(self, zones):
+        """
+        Conservatively evaluate the predicate on blocks of rows using their
+        summaries
+        @param zones A ZoneMap
+        @return a 2-tuple of boolean arrays (mayBeTrue, mayBeFalse) for each
+        block, a block which cannot contain a row for which the predicate is
+        true can be skipped
+        """
+        raise NotImplementedError()
+
+
+class And(Predicate):
+
+    def __init__(self, a, b):
+        self.a = _checkPredicate(a)
+        self.b = _checkPredicate(b)
+
+    def columns(self):
+        return self.a.columns().union(self.b.columns())
+
+    def evaluate(self, arrays):
+        at, af = self.a.evaluate(arrays)
+        bt, bf = self.b.evaluate(arrays)
+        return at & bt, af | bf
+
+    def evaluateBlocks(self, zones):
+        at, af = self.a.evaluateBlocks(zones)
+        bt, bf = self.b.evaluateBlocks(zones)
+        return at & bt, af | bf
+
+    def __repr__(self):
+        return '(%r & %r)' % (self.a, self.b)
+
+
+class Or(Predicate):
+
+    def __init__(self, a, b):
+        self.a = _checkPredicate(a)
+        self.b = _checkPredicate(b)
+
+    def columns(self):
+        return self.a.columns().union(self.b.columns())
+
+    def evaluate(self, arrays):
+        at, af = self.a.evaluate(arrays)
+        bt, bf = self.b.evaluate(arrays)
+        return at | bt, af & bf
+
+    def evaluateBlocks(self, zones):
+        at, af = self.a.evaluateBlocks(zones)
+        bt, bf = self.b.evaluateBlocks(zones)
+        return at | bt, af & bf
+
+    def __repr__(self):
+        return '(%r | %r)' % (self.a, self.b)
+
+
+class Not(Predicate):
+
+    def __init__(self, a):
+        self.a = _checkPredicate(a)
+
+    def columns(self):
+        return self.a.columns()
+
+    def evaluate(self, arrays):
+        t, f = self.a.evaluate(arrays)
+        return f, t
+
+    def evaluateBlocks(self, zones):
+        t, f = self.a.evaluateBlocks(zones)
+        return f, t
+
+    def __repr__(self):
+        return '~%r' % self.a
+
+
+class IsNull(Predicate):
+    """
+    True if a column is null, never unknown
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def columns(self):
+        return set([self.name])
+
+    def evaluate(self, arrays):
+        valid = arrays[self.name].valid
+        return ~valid, valid.copy()
+
+    def evaluateBlocks(self, zones):
+        nulls = zones.nulls[self.name]
+        return nulls > 0, nulls < zones.rows
+
+    def __repr__(self):
+        return 'Feature(%r).isNull()' % self.name
+
+
+class Comparison(Predicate):
+    """
+    Compares a reduced column value against a threshold, unknown where the
+    column is null
+    """
+
+    # Python operator: (function, symbol)
+    operators = {
+        'lt': (operator.lt, '<'),
+        'le': (operator.le, '<='),
+        'eq': (operator.eq, '=='),
+        'ne': (operator.ne, '!='),
+        'ge': (operator.ge, '>='),
+        'gt': (operator.gt, '>'),
+        }
+
+    def __init__(self, value, op, threshold):
+        """
+        @param value A Value
+        @param op One of the keys of operators
+        @param threshold A number
+        """
+        if op not in self.operators:
+            raise TableConnectionError('Invalid operator: %s' % op)
+        try:
+            float(threshold)
+        except (TypeError, ValueError):
+            raise TableConnectionError(
+                'Threshold must be a number: %r' % (threshold,))
+        self.value = value
+        self.op = op
+        self.threshold = threshold
+
+    def columns(self):
+        return set([self.value.name])
+
+    def evaluate(self, arrays):
+        a = arrays[self.value.name]
+        cmp = self.operators[self.op][0]
+        r = self.value.reduce(a.values, lambda x: cmp(x, self.threshold))
+        return r & a.valid, ~r & a.valid
+
+    def evaluateBlocks(self, zones):
+        """
+        Every element, element mean, min and max of a block lies within the
+        block min and max, so a block can be skipped if no value in that
+        range can satisfy the comparison. Sums and != are not checked, and
+        the result is never known to be false since elements may be NaN.
+        """
+        name = self.value.name
+        lo = zones.min[name]
+        hi = zones.max[name]
+        hasValid = zones.nulls[name] < zones.rows
+        if self.op == 'ne' or self.value.reduction == 'sum':
+            return hasValid, hasValid
+        t = self.threshold
+        with numpy.errstate(invalid='ignore'):
+            if self.op == 'lt':
+                mayBeTrue = lo < t
+            elif self.op == 'le':
+                mayBeTrue = lo <= t
+            elif self.op == 'eq':
+                mayBeTrue = (lo <= t) & (hi >= t)
+            elif self.op == 'ge':
+                mayBeTrue = hi >= t
+            else:
+                mayBeTrue = hi > t
+        return mayBeTrue & hasValid, hasValid
+
+    def __repr__(self):
+        return '(%r %s %r)' % (
+            self.value, self.operators[self.op][1], self.threshold)
+
+
+class Value(object):
+    """
+    A per-row value derived from a column, comparing it with a number gives
+    a Comparison predicate
+    """
+
+    # reduction: (function applied before comparison, after comparison)
+    reductions = {
+        None: (None, None),
+        'all': (None, numpy.all),
+        'any': (None, numpy.any),
+        'mean': (numpy.mean, None),
+        'min': (numpy.min, None),
+        'max': (numpy.max, None),
+        'sum': (numpy.sum, None),
+        }
+
+    def __init__(self, name, reduction = None, index = None):
+        """
+        @param name The column name
+        @param reduction One of the keys of reductions
+        @param index An array element index, if set reduction is ignored
+        """
+        self.name = name
+        self.reduction = reduction
+        self.index = index
+
+    def reduce(self, values, compare):
+        """
+        Apply the reduction and comparison to a block of values
+        @param values A 1-D array (scalar column) or 2-D array (rows x size)
+        @param compare A function which compares an array to the threshold
+        @return a 1-D boolean array
+        """
+        if values.ndim == 1:
+            if self.index is not None:
+                raise TableConnectionError(
+                    'Column %s is not an array' % self.name)
+            return compare(values)
+
+        if self.index is not None:
+            if not -values.shape[1] <= self.index < values.shape[1]:
+                raise TableConnectionError(
+                    'Index %d out of range for column %s' %
+                    (self.index, self.name))
+            return compare(values[:, self.index])
+        before, after = self.reductions[self.reduction]
+        if before:
+            return compare(before(values, axis=1))
+        if after:
+            return after(compare(values), axis=1)
+        raise TableConnectionError(
+            'Array column %s must be reduced with all(), any(), mean(), '
+            'min(), max(), sum() or an index' % self.name)
+
+    def __lt__(self, x):
+        return Comparison(self, 'lt', x)
+
+    def __le__(self, x):
+        return Comparison(self, 'le', x)
+
+    def __eq__(self, x):
+        return Comparison(self, 'eq', x)
+
+    def __ne__(self, x):
+        return Comparison(self, 'ne', x)
+
+    def __ge__(self, x):
+        return Comparison(self, 'ge', x)
+
+    def __gt__(self, x):
+        return Comparison(self, 'gt', x)
+
+    def between(self, low, high):
+        """
+        @return a predicate which is true if low <= value <= high
+        """
+        return (self >= low) & (self <= high)
+
+    def __repr__(self):
+        if self.index is not None:
+            return 'Feature(%r)[%d]' % (self.name, self.index)
+        if self.reduction:
+            return 'Feature(%r).%s()' % (self.name, self.reduction)
+        return 'Feature(%r)' % self.name
+
+
+class Feature(Value):
+    """
+    A column referred to by name
+    """
+
+    def __init__(self, name):
+        super(Feature, self).__init__(name)
+
+    def all(self):
+        return Value(self.name, 'all')
+
+    def any(self):
+        return Value(self.name, 'any')
+
+    def mean(self):
+        return Value(self.name, 'mean')
+
+    def min(self):
+        return Value(self.name, 'min')
+
+    def max(self):
+        return Value(self.name, 'max')
+
+    def sum(self):
+        return Value(self.name, 'sum')
+
+    def __getitem__(self, i):
+        return Value(self.name, index=i)
+
+    def isNull(self):
+        return IsNull(self.name)
+
+    def notNull(self):
+        return Not(IsNull(self.name))
+
+
+def _checkPredicate(p):
+    """
+    Internal helper method, catches mistakes such as using and/or instead
+    of &/| or forgetting to compare a Value
+    """
+    if not isinstance(p, Predicate):
+        raise TableConnectionError('Expected a predicate, got %r' % (p,))
+    return p
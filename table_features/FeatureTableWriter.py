@@ -0,0 +1,177 @@
+#
+#
+import numpy
+import time
+from TableConnection import TableConnectionError
+
+
+class FeatureTableWriter(object):
+    """
+    Buffers rows written to a FeatureTableConnection and adds them to the
+    table in a few large batches instead of one call per row.
+
+    Rows may be added one at a time or as columns, and different rows may
+    contain different subsets of columns, missing columns are null. The
+    buffer is flushed when it reaches maxRows rows, maxBytes bytes of
+    feature data, or when the oldest buffered row is older than maxSeconds.
+    Thresholds are checked when rows are added, there is no background
+    thread, so call flush() or close() (or use a with statement) to ensure
+    all rows are written.
+    """
+
+    def __init__(self, tc, maxRows = 1000, maxBytes = None, maxSeconds = None):
+        """
+        @param tc A FeatureTableConnection with an open table
+        @param maxRows Flush after this many rows have been buffered
+        @param maxBytes Flush after this many bytes of data have been
+        buffered, or None
+        @param maxSeconds Flush when the oldest buffered row is older than
+        this, or None
+        """
+        self.tc = tc
+        self.maxRows = maxRows
+        self.maxBytes = maxBytes
+        self.maxSeconds = maxSeconds
+
+        headers = tc.getHeaders()
+        self.idColName = headers[0].name
+        self.sizes = dict((h.name, h.size) for h in headers[1:])
+        self.rowsWritten = 0
+        self._reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Write any buffered rows
+        """
+        self.flush()
+
+    def addRow(self, id, features):
+        """
+        Buffer a single row
+        @param id The id of the row
+        @param features A dictionary mapping column names to lists or arrays
+        of values. Columns which are missing, None or empty are null.
+        """
+        features = [(name, v) for (name, v) in features.iteritems()
+                    if v is not None and len(v)]
+        for (name, v) in features:
+            self._checkValue(name, v)
+
+        r = len(self._ids)
+        for (name, v) in features:
+            self._bufferValue(name, r, v)
+        self._ids.append(id)
+        self._rowsAdded(1)
+
+    def addPartialData(self, cols):
+        """
+        Buffer one or more rows, has the same arguments as
+        FeatureTableConnection.addPartialData
+        @param cols A subset of the columns obtained from getHeaders() whose
+        values have been filled with the data to be added. Missing columns
+        are automatically treated as nulls.
+        """
+        columnMap = dict([(c.name, c) for c in cols])
+        try:
+            ids = columnMap.pop(self.idColName).values
+        except KeyError:
+            raise TableConnectionError(
+                "First column (%s) must be provided" % self.idColName)
+
+        for c in columnMap.itervalues():
+            if len(c.values) != len(ids):
+                raise TableConnectionError(
+                    "Expected %d rows in column %s, got %d" %
+                    (len(ids), c.name, len(c.values)))
+            for v in c.values:
+                if len(v):
+                    self._checkValue(c.name, v)
+
+        r = len(self._ids)
+        for c in columnMap.itervalues():
+            for (n, v) in enumerate(c.values):
+                if len(v):
+                    self._bufferValue(c.name, r + n, v)
+        self._ids.extend(ids)
+        self._rowsAdded(len(ids))
+
+    def addData(self, cols):
+        """
+        Buffer one or more rows, has the same arguments as
+        FeatureTableConnection.addData
+        """
+        self.addPartialData(cols)
+
+    def flush(self):
+        """
+        Add all buffered rows to the table in a single call
+        """
+        nRows = len(self._ids)
+        if not nRows:
+            return
+
+        arrays = {self.idColName: self._ids}
+        valid = {}
+        for (name, (rows, values)) in self._buffer.iteritems():
+            a = numpy.zeros((nRows, self.sizes[name]))
+            a[rows] = values
+            v = numpy.zeros(nRows, dtype=bool)
+            v[rows] = True
+            arrays[name] = a
+            valid[name] = v
+
+        self.tc.addArrays(arrays, valid)
+        self.rowsWritten += nRows
+        self._reset()
+
+    def _checkValue(self, name, v):
+        """
+        Internal helper method, checks an array value matches the table
+        """
+        try:
+            size = self.sizes[name]
+        except KeyError:
+            raise TableConnectionError("Unexpected column: %s" % name)
+        if len(v) != size:
+            raise TableConnectionError(
+                "Expected %d values for column %s, got %d" %
+                (size, name, len(v)))
+
+    def _bufferValue(self, name, row, v):
+        """
+        Internal helper method, adds a checked array value to the buffer
+        """
+        rows, values = self._buffer.setdefault(name, ([], []))
+        rows.append(row)
+        values.append(v)
+        self._nBytes += 8 * len(v)
+
+    def _rowsAdded(self, n):
+        """
+        Internal helper method, flushes the buffer if a threshold is exceeded
+        @param n The number of rows which have just been added
+        """
+        self._nBytes += 8 * n
+        if self._started is None:
+            self._started = time.time()
+
+        if len(self._ids) >= self.maxRows or \
+                (self.maxBytes and self._nBytes >= self.maxBytes) or \
+                (self.maxSeconds is not None and
+                 time.time() - self._started >= self.maxSeconds):
+            self.flush()
+
+    def _reset(self):
+        """
+        Internal helper method, empties the buffer
+        """
+        self._ids = []
+        self._buffer = {}
+        self._nBytes = 0
+        self._started = None
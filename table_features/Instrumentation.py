@@ -0,0 +1,228 @@
+#
+#
+"""
+Instrumentation of remote table calls made by TableConnection
+
+Every call to the table (read, addData, getHeaders, getWhereList,
+getNumberOfRows, ...) and every openTable/newTable is recorded as an Event
+with the wall time, the number of rows and the approximate number of bytes
+of column data transferred. Events are passed to a set of sinks:
+    MemorySink: accumulates per-operation totals, see snapshot()
+    LoggingSink: logs every event
+    CallbackSink: calls a function with every event, e.g. for a metrics
+    exporter
+
+Usage:
+    stats = MemorySink()
+    tc = FeatureTableConnection(..., sinks=[stats])
+    tc.readArray(...)
+    print stats.snapshot()['read']
+"""
+
+from collections import namedtuple
+import logging
+import threading
+import time
+from omero.grid import BoolColumn, LongArrayColumn, DoubleArrayColumn
+
+
+# operation: The name of the call
+# seconds: Wall time
+# rows: The number of rows read, written or returned
+# bytes: The approximate size of the column data sent or received
+# error: The exception raised by the call, or None
+Event = namedtuple('Event', ['operation', 'seconds', 'rows', 'bytes',
+                             'error'])
+
+
+class Instrumentation(object):
+    """
+    Records events and passes them to the registered sinks
+    """
+
+    def __init__(self, sinks = None):
+        """
+        @param sinks An optional list of sinks
+        """
+        self.sinks = list(sinks or [])
+
+    def addSink(self, sink):
+        self.sinks.append(sink)
+
+    def removeSink(self, sink):
+        self.sinks.remove(sink)
+
+    def record(self, operation, seconds, rows = 0, nbytes = 0, error = None):
+        """
+        Pass an event to all sinks
+        """
+        event = Event(operation, seconds, rows, nbytes, error)
+        for sink in self.sinks:
+            sink.record(event)
+
+    def call(self, operation, f, *args, **kwargs):
+        """
+        Call a function and record its wall time, the number of rows and
+        bytes are obtained from the arguments or result, see measure()
+        @param operation The name of the operation
+        @param f The function to call with args and kwargs
+        @return the result of f
+        """
+        if not self.sinks:
+            return f(*args, **kwargs)
+
+        t0 = time.time()
+        try:
+            result = f(*args, **kwargs)
+        except Exception as e:
+            self.record(operation, time.time() - t0, error=e)
+            raise
+        seconds = time.time() - t0
+        rows, nbytes = measure(operation, args, result)
+        self.record(operation, seconds, rows, nbytes)
+        return result
+
+
+class InstrumentedTable(object):
+    """
+    A proxy for an omero.grid.Table handle which records every call
+    """
+
+    def __init__(self, table, instrumentation):
+        """
+        @param table The table handle
+        @param instrumentation An Instrumentation object
+        """
+        self._table = table
+        self._instrumentation = instrumentation
+
+    def __getattr__(self, name):
+        attr = getattr(self._table, name)
+        if not callable(attr):
+            return attr
+
+        def instrumented(*args, **kwargs):
+            return self._instrumentation.call(name, attr, *args, **kwargs)
+        return instrumented
+
+    def unwrap(self):
+        """
+        @return the underlying table handle
+        """
+        return self._table
+
+
+class MemorySink(object):
+    """
+    Accumulates the count, wall time, rows, bytes and errors of each
+    operation, thread-safe
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def record(self, event):
+        with self._lock:
+            s = self._stats.get(event.operation)
+            if s is None:
+                s = self._stats[event.operation] = {
+                    'count': 0, 'seconds': 0.0, 'maxSeconds': 0.0,
+                    'rows': 0, 'bytes': 0, 'errors': 0}
+            s['count'] += 1
+            s['seconds'] += event.seconds
+            s['maxSeconds'] = max(s['maxSeconds'], event.seconds)
+            s['rows'] += event.rows
+            s['bytes'] += event.bytes
+            if event.error is not None:
+                s['errors'] += 1
+
+    def snapshot(self):
+        """
+        @return a dictionary mapping operation names to dictionaries of
+        count, seconds, maxSeconds, rows, bytes and errors
+        """
+        with self._lock:
+            return dict((k, dict(v)) for (k, v) in self._stats.iteritems())
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+
+class LoggingSink(object):
+    """
+    Logs every event
+    """
+
+    def __init__(self, logger = None, level = logging.DEBUG):
+        """
+        @param logger The logger, default is table_features.instrumentation
+        @param level The log level for successful calls, errors are logged
+        as warnings
+        """
+        self.logger = logger or logging.getLogger(
+            'table_features.instrumentation')
+        self.level = level
+
+    def record(self, event):
+        if event.error is None:
+            self.logger.log(self.level, '%s %.6fs rows:%d bytes:%d',
+                            event.operation, event.seconds, event.rows,
+                            event.bytes)
+        else:
+            self.logger.warning('%s %.6fs failed: %s', event.operation,
+                                event.seconds, event.error)
+
+
+class CallbackSink(object):
+    """
+    Calls a function with every event
+    """
+
+    def __init__(self, callback):
+        """
+        @param callback A function taking an Event
+        """
+        self.callback = callback
+
+    def record(self, event):
+        self.callback(event)
+
+
+def measure(operation, args, result):
+    """
+    Estimate the number of rows and bytes transferred by a table call
+    @param operation The name of the method
+    @param args The positional arguments
+    @param result The result
+    @return a 2-tuple (rows, bytes)
+    """
+    if operation == 'addData' and args:
+        return _columnsSize(args[0])
+    if operation in ('read', 'readCoordinates', 'slice') and \
+            hasattr(result, 'columns'):
+        return _columnsSize(result.columns)
+    if operation == 'getWhereList' and result is not None:
+        return len(result), 8 * len(result)
+    return 0, 0
+
+
+def _columnsSize(columns):
+    """
+    Internal helper method, estimates the size of a list of columns
+    @return a 2-tuple (rows, bytes)
+    """
+    if not columns:
+        return 0, 0
+    rows = len(columns[0].values or [])
+    nbytes = 0
+    for c in columns:
+        if isinstance(c, BoolColumn):
+            width = 1
+        elif isinstance(c, (LongArrayColumn, DoubleArrayColumn)):
+            width = 8 * (c.size or 0)
+        else:
+            width = 8
+        nbytes += width * len(c.values or [])
+    return rows, nbytes
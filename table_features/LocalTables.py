@@ -0,0 +1,405 @@
+#
+#
+"""
+An in-process stand-in for OMERO.tables which stores tables in local
+HDF5 files using PyTables, so that TableConnection and
+FeatureTableConnection can be tested and benchmarked without a server.
+
+Only the subset of the OMERO API used by this package is implemented.
+Select it by passing localDir to the TableConnection constructor.
+"""
+
+import json
+import os
+import threading
+import time
+import numpy
+import tables
+import omero
+import omero.grid
+from omero.rtypes import rlong, rstring, unwrap
+
+
+# OMERO column type name: (PyTables column class, is array)
+COLUMN_TYPES = {
+    'LongColumn': (tables.Int64Col, False),
+    'BoolColumn': (tables.BoolCol, False),
+    'DoubleColumn': (tables.Float64Col, False),
+    'LongArrayColumn': (tables.Int64Col, True),
+    'DoubleArrayColumn': (tables.Float64Col, True),
+}
+
+
+class LocalOriginalFile(object):
+    """
+    The parts of an omero.model.OriginalFile used by TableConnection
+    """
+
+    def __init__(self, id, name):
+        self.id = rlong(id)
+        self.name = rstring(name)
+
+    def getId(self):
+        return self.id
+
+    def getName(self):
+        return self.name
+
+
+class LocalOriginalFileWrapper(object):
+    """
+    The parts of an omero.gateway.OriginalFileWrapper used by TableConnection
+    """
+
+    def __init__(self, ofile):
+        self._obj = ofile
+
+    def getId(self):
+        return self._obj.id.val
+
+    def getName(self):
+        return self._obj.name.val
+
+
+class LocalRepository(object):
+    """
+    Repository description, only the id is used
+    """
+
+    def __init__(self, id):
+        self.id = rlong(id)
+
+
+class LocalRepositories(object):
+    """
+    Result of sharedResources().repositories()
+    """
+
+    def __init__(self):
+        self.descriptions = [LocalRepository(1)]
+
+
+class LocalTableService(object):
+    """
+    Replaces both the BlitzGateway and the SharedResources service in a
+    TableConnection. Each table is stored in a separate HDF5 file in a local
+    directory, an index file maps OriginalFile ids to table names.
+    """
+
+    indexName = 'tables.json'
+
+    def __init__(self, directory):
+        """
+        @param directory The directory holding the tables, will be created
+        if necessary
+        """
+        self.directory = os.path.abspath(directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    # SharedResources
+
+    def areTablesEnabled(self):
+        return True
+
+    def repositories(self):
+        return LocalRepositories()
+
+    def newTable(self, rid, name):
+        """
+        @return a new uninitialised LocalTable
+        """
+        with _indexLock:
+            index = self._readIndex()
+            id = index['nextId']
+            index['nextId'] = id + 1
+            index['tables'][str(id)] = name
+            self._writeIndex(index)
+        return LocalTable(self, LocalOriginalFile(id, name))
+
+    def openTable(self, ofile):
+        """
+        @return a LocalTable
+        """
+        return LocalTable(
+            self, LocalOriginalFile(ofile.id.val, unwrap(ofile.name)))
+
+    # BlitzGateway
+
+    def getObjects(self, objType, attributes = None):
+        """
+        @return a list of OriginalFile wrappers matching attributes
+        """
+        if objType != 'OriginalFile':
+            raise omero.ApiUsageException(
+                None, None, 'Unsupported object type: %s' % objType)
+        if not attributes:
+            attributes = {}
+        with _indexLock:
+            index = self._readIndex()
+        ofiles = []
+        for (id, name) in sorted(index['tables'].iteritems(),
+                                 key=lambda x: long(x[0])):
+            if 'id' in attributes and long(id) != attributes['id']:
+                continue
+            if 'name' in attributes and name != attributes['name']:
+                continue
+            ofiles.append(LocalOriginalFileWrapper(
+                    LocalOriginalFile(long(id), name)))
+        return ofiles
+
+    def getObject(self, objType, attributes = None):
+        """
+        @return a single OriginalFile wrapper matching attributes, or None
+        """
+        ofiles = self.getObjects(objType, attributes)
+        if len(ofiles) > 1:
+            raise omero.ApiUsageException(
+                None, None, 'Multiple objects found')
+        if ofiles:
+            return ofiles[0]
+        return None
+
+    def deleteObjects(self, objType, ids):
+        """
+        Delete tables
+        """
+        for id in ids:
+            _closeStore(self.tablePath(id))
+            with _indexLock:
+                index = self._readIndex()
+                index['tables'].pop(str(id), None)
+                self._writeIndex(index)
+            if os.path.exists(self.tablePath(id)):
+                os.remove(self.tablePath(id))
+
+    def _closeSession(self):
+        pass
+
+    def tablePath(self, id):
+        """
+        @return the path to the HDF5 file holding table id
+        """
+        return os.path.join(self.directory, 'table-%d.h5' % id)
+
+    def _readIndex(self):
+        try:
+            with open(os.path.join(self.directory, self.indexName)) as f:
+                return json.load(f)
+        except IOError:
+            return {'nextId': 1, 'tables': {}}
+
+    def _writeIndex(self, index):
+        path = os.path.join(self.directory, self.indexName)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.rename(path + '.tmp', path)
+
+
+class LocalTable(object):
+    """
+    A table handle implementing the subset of omero.grid.Table used by
+    this package. Columns are stored as fields c0, c1, ... of a PyTables
+    Table, the OMERO column definitions are stored as an attribute.
+    """
+
+    def __init__(self, service, ofile):
+        """
+        @param service The LocalTableService
+        @param ofile The LocalOriginalFile for this table
+        """
+        self.service = service
+        self.ofile = ofile
+        self.store = _openStore(service.tablePath(ofile.id.val))
+
+    def getOriginalFile(self):
+        return self.ofile
+
+    def initialize(self, cols):
+        """
+        Create the table
+        @param cols A list of columns describing the table
+        """
+        desc = {}
+        defs = []
+        for (n, c) in enumerate(cols):
+            typeName = type(c).__name__
+            try:
+                colType, isArray = COLUMN_TYPES[typeName]
+            except KeyError:
+                raise omero.ApiUsageException(
+                    None, None, 'Unsupported column type: %s' % typeName)
+            if isArray:
+                desc['c%d' % n] = colType(shape=(c.size,), pos=n)
+                defs.append((typeName, c.name, c.description, c.size))
+            else:
+                desc['c%d' % n] = colType(pos=n)
+                defs.append((typeName, c.name, c.description, None))
+
+        with self.store.lock:
+            h = self.store.h5
+            if '/table' in h:
+                raise omero.ApiUsageException(
+                    None, None, 'Table already initialized')
+            t = h.createTable('/', 'table', desc)
+            t.attrs.columns = json.dumps(defs)
+            h.flush()
+
+    def getHeaders(self):
+        """
+        @return a list of empty columns
+        """
+        with self.store.lock:
+            t = self._table()
+            defs = json.loads(t.attrs.columns)
+        headers = []
+        for (typeName, name, description, size) in defs:
+            colClass = getattr(omero.grid, typeName)
+            if size is None:
+                headers.append(colClass(name, description, None))
+            else:
+                headers.append(colClass(name, description, size, None))
+        return headers
+
+    def getNumberOfRows(self):
+        with self.store.lock:
+            return self._table().nrows
+
+    def addData(self, cols):
+        """
+        Append rows
+        @param cols A list of all columns filled with the data to be added
+        """
+        with self.store.lock:
+            t = self._table()
+            if len(cols) != len(t.colnames):
+                raise omero.ApiUsageException(
+                    None, None, 'Expected %d columns, got %d' %
+                    (len(t.colnames), len(cols)))
+            nRows = len(cols[0].values)
+            rows = numpy.empty(nRows, dtype=t.dtype)
+            for (n, c) in enumerate(cols):
+                if len(c.values) != nRows:
+                    raise omero.ApiUsageException(
+                        None, None, 'Column %s has %d rows, expected %d' %
+                        (c.name, len(c.values), nRows))
+                rows['c%d' % n] = c.values
+            t.append(rows)
+            t.flush()
+            self.store.lastModified = long(time.time() * 1000)
+
+    def read(self, colNumbers, start, stop):
+        """
+        Read a range of rows
+        @param colNumbers A list of column indices
+        @param start The first row to be read
+        @param stop The last + 1 row to be read
+        @return an omero.grid.Data object
+        """
+        headers = self.getHeaders()
+        with self.store.lock:
+            t = self._table()
+            stop = max(min(stop, t.nrows), start)
+            # Reading a field reads whole records, so read them only once
+            if len(colNumbers) > 1:
+                rows = t.read(start, stop)
+                read = lambda field: rows[field]
+            else:
+                read = lambda field: t.read(start, stop, field=field)
+            columns = []
+            for n in colNumbers:
+                c = headers[n]
+                c.values = read('c%d' % n).tolist()
+                columns.append(c)
+            lastModified = self.store.lastModified
+
+        data = omero.grid.Data()
+        data.columns = columns
+        data.rowNumbers = range(start, stop)
+        data.lastModified = lastModified
+        return data
+
+    def getWhereList(self, condition, variables, start, stop, step):
+        """
+        Find the rows matching a PyTables condition in which columns are
+        referred to by name
+        @return a list of row indices
+        """
+        headers = self.getHeaders()
+        with self.store.lock:
+            t = self._table()
+            condvars = dict((c.name, t.cols._f_col('c%d' % n))
+                            for (n, c) in enumerate(headers))
+            if variables:
+                condvars.update((k, unwrap(v))
+                                for (k, v) in variables.iteritems())
+            return t.getWhereList(condition, condvars, start=start,
+                                  stop=stop, step=(step or None)).tolist()
+
+    def close(self):
+        if self.store:
+            _releaseStore(self.store)
+            self.store = None
+
+    def delete(self):
+        self.close()
+        self.service.deleteObjects(
+            'OriginalFile', [self.ofile.id.val])
+
+    def _table(self):
+        if not self.store:
+            raise omero.ApiUsageException(None, None, 'Table is closed')
+        try:
+            return self.store.h5.root.table
+        except tables.NoSuchNodeError:
+            raise omero.ApiUsageException(
+                None, None, 'Table has not been initialized')
+
+
+class _LocalTableStore(object):
+    """
+    An open HDF5 file shared by all LocalTable handles to the same table,
+    since PyTables does not allow a file to be opened for writing more than
+    once. Access is serialised by a lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.h5 = tables.openFile(path, 'a')
+        self.lock = threading.RLock()
+        self.refs = 0
+        self.lastModified = long(os.path.getmtime(path) * 1000)
+
+
+_stores = {}
+_storesLock = threading.Lock()
+_indexLock = threading.Lock()
+
+
+def _openStore(path):
+    with _storesLock:
+        try:
+            store = _stores[path]
+        except KeyError:
+            store = _stores[path] = _LocalTableStore(path)
+        store.refs += 1
+        return store
+
+
+def _releaseStore(store):
+    with _storesLock:
+        store.refs -= 1
+        if store.refs == 0 and _stores.get(store.path) is store:
+            del _stores[store.path]
+            store.h5.close()
+
+
+def _closeStore(path):
+    """
+    Close a store even if it is still in use, because the table is being
+    deleted
+    """
+    with _storesLock:
+        store = _stores.pop(path, None)
+        if store:
+            store.h5.close()
@@ -1,11 +1,37 @@
 #
 #
-from itertools import izip
+from bisect import bisect_left
+from collections import OrderedDict
+from itertools import compress, izip
+import logging
+import numpy
 import omero
+import Queue
+import sys
+import threading
+import warnings
 from copy import deepcopy
 from omero.gateway import BlitzGateway
-from omero.grid import LongColumn, BoolColumn, \
+from omero.rtypes import unwrap
+from omero.grid import LongColumn, BoolColumn, DoubleColumn, \
     LongArrayColumn, DoubleArrayColumn
+from Instrumentation import Instrumentation, InstrumentedTable
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+# Result formats for FeatureTableConnection reads
+COLUMNS = 'columns'
+NDARRAY = 'ndarray'
+MASKED = 'masked'
+
+# FeatureTableConnection table layouts:
+# One BoolColumn per data column indicating whether it is valid
+LAYOUT_BOOL = 1
+# The validity flags of each row packed into LongColumn bitmasks
+LAYOUT_PACKED = 2
 
 
 class TableConnectionError(Exception):
@@ -21,8 +47,12 @@ class TableConnection(object):
     and closing tables.
     """
 
+    # The maximum number of conditions whose getWhereList results are cached
+    whereCacheSize = 100
+
     def __init__(self, user = None, passwd = None, host = 'localhost',
-                 client = None, tableName = None, tableId = None):
+                 client = None, tableName = None, tableId = None,
+                 localDir = None, sinks = None):
         """
         Create a new table handler, either by specifying user and passwd or by
         providing a client object (for scripts)
@@ -32,17 +62,26 @@ class TableConnection(object):
         @param client Client object with an active session
         @param tableName The name of the table file
         @param tableId The OriginalFile ID of the table file
+        @param localDir If set don't connect to a server, instead store
+        tables as HDF5 files in this directory (see LocalTables)
+        @param sinks An optional list of sinks which receive the timings of
+        all calls to the table, see Instrumentation
         """
-        if not client:
-            client = omero.client(host)
-            sess = client.createSession(user, passwd)
-            client.enableKeepAlive(60)
+        self.instrumentation = Instrumentation(sinks)
+        if localDir:
+            from LocalTables import LocalTableService
+            self.conn = self.res = LocalTableService(localDir)
         else:
-             sess = client.getSession()
+            if not client:
+                client = omero.client(host)
+                sess = client.createSession(user, passwd)
+                client.enableKeepAlive(60)
+            else:
+                sess = client.getSession()
 
-        self.conn = BlitzGateway(client_obj = client)
+            self.conn = BlitzGateway(client_obj = client)
+            self.res = sess.sharedResources()
 
-        self.res = sess.sharedResources()
         if (not self.res.areTablesEnabled()):
             raise TableConnectionError('OMERO.tables not enabled')
 
@@ -52,17 +91,19 @@ class TableConnection(object):
         self.tableName = tableName
         self.tableId = tableId
         self.table = None
+        # (condition, variables): (rows covered, matching rows)
+        self._whereCache = OrderedDict()
 
     def __enter__(self):
-        print 'Entering Connection'
+        log.debug('Entering Connection')
         return self
 
     def __exit__(self, type, value, traceback):
-        print 'Exiting Connection'
+        log.debug('Exiting Connection')
         self.close()
 
     def close(self):
-        print 'Closing Connection'
+        log.debug('Closing Connection')
         try:
             self.closeTable()
         finally:
@@ -107,21 +148,24 @@ class TableConnection(object):
                                        (tableName, tableId))
 
         if self.tableId == ofile.getId():
-            print 'Using existing connection to table name:%s id:%d' % \
-                (tableName, tableId)
+            log.debug('Using existing connection to table name:%s id:%s',
+                      tableName, self.tableId)
         else:
             self.closeTable()
-            self.table = self.res.openTable(ofile._obj)
+            self.table = InstrumentedTable(
+                self.instrumentation.call(
+                    'openTable', self.res.openTable, ofile._obj),
+                self.instrumentation)
             self.tableId = ofile.getId()
-            print 'Opened table name:%s id:%d' % (tableName, self.tableId)
+            log.info('Opened table name:%s id:%s', tableName, self.tableId)
 
-        try:
-            print '\t%d rows %d columns' % \
-                (self.table.getNumberOfRows(), len(self.table.getHeaders()))
-        except omero.ApiUsageException:
-            pass
+        if log.isEnabledFor(logging.DEBUG):
+            try:
+                log.debug('%d rows %d columns', self.table.getNumberOfRows(),
+                          len(self.table.getHeaders()))
+            except omero.ApiUsageException:
+                pass
 
-        self.tableId = tableId
         return self.table
 
 
@@ -133,22 +177,23 @@ class TableConnection(object):
         ofiles = self.conn.getObjects("OriginalFile", \
             attributes = {'name': self.tableName})
         ids = [f.getId() for f in ofiles]
-        print 'Deleting ids:%s' % ids
+        log.info('Deleting ids:%s', ids)
         self.conn.deleteObjects('OriginalFile', ids)
 
 
-    def dumpTable(self, table):
+    def dumpTable(self, table, chunk = 1000):
         """
         Print out the table
+        @param chunk The number of rows read in each call
         """
         headers = table.getHeaders()
         print ', '.join([t.name for t in headers])
         nrows = table.getNumberOfRows()
-        #data = table.readCoordinates(xrange(table.getNumberOfRows))
 
-        for r in xrange(nrows):
-            data = table.read(range(len(headers)), r, r + 1)
-            print ', '.join(['%.2f' % c.values[0] for c in data.columns])
+        for p in xrange(0, nrows, chunk):
+            data = table.read(range(len(headers)), p, min(p + chunk, nrows))
+            for r in xrange(len(data.rowNumbers)):
+                print ', '.join(['%.2f' % c.values[r] for c in data.columns])
 
 
     def closeTable(self):
@@ -161,6 +206,18 @@ class TableConnection(object):
         finally:
             self.table = None
             self.tableId = None
+            self._whereCache.clear()
+
+
+    def deleteTable(self):
+        """
+        Delete the open table if any, and close it
+        """
+        try:
+            if self.table:
+                self.table.delete()
+        finally:
+            self.closeTable()
 
 
     def newTable(self, schema):
@@ -171,19 +228,22 @@ class TableConnection(object):
         """
         self.closeTable()
 
-        self.table = self.res.newTable(self.rid, self.tableName)
+        self.table = InstrumentedTable(
+            self.instrumentation.call(
+                'newTable', self.res.newTable, self.rid, self.tableName),
+            self.instrumentation)
         ofile = self.table.getOriginalFile()
         self.tableId = ofile.getId().getValue()
 
         try:
             self.table.initialize(schema)
-            print "Initialised '%s' (%d)" % (self.tableName, self.tableId)
+            log.info("Initialised '%s' (%d)", self.tableName, self.tableId)
         except Exception as e:
-            print "Failed to create table: %s" % e
+            log.error("Failed to create table: %s", e)
             try:
-                self.table.delete
+                self.table.delete()
             except Exception as ed:
-                print "Failed to delete table: %s" % ed
+                log.error("Failed to delete table: %s", ed)
 
             self.table = None
             self.tableId = None
@@ -192,6 +252,65 @@ class TableConnection(object):
         return self.table
 
 
+    def getWhereList(self, condition, variables = None, start = 0,
+                     stop = None, step = None):
+        """
+        Find the rows matching a condition, see omero.grid.Table.getWhereList
+        Rows can only be appended to a table so the matches in rows [0, n)
+        never change. Results are cached for each condition and set of
+        variables together with the number of rows they cover, and later
+        calls only evaluate the condition on rows which have been added
+        since.
+        @param condition A PyTables condition string
+        @param variables A dictionary mapping variable names used in the
+        condition to omero rtypes
+        @param start The first row to be searched
+        @param stop The last + 1 row to be searched, default is the end of
+        the table
+        @param step If set only search every step rows, results are not
+        cached
+        @return a list of matching row indices, sorted unless the range
+        starts after the rows covered by the cache or step is set
+        """
+        if variables is None:
+            variables = {}
+        nrows = self.table.getNumberOfRows()
+        if stop is None or stop > nrows:
+            stop = nrows
+        if start >= stop:
+            return []
+
+        try:
+            key = (condition, tuple(sorted(
+                        (k, unwrap(v)) for (k, v) in variables.iteritems())))
+            hash(key)
+        except TypeError:
+            key = None
+        if key is None or (step and step != 1):
+            return self.table.getWhereList(
+                condition, variables, start, stop, step or 0)
+
+        covered, rows = self._whereCache.pop(key, (0, []))
+        if start > covered:
+            # Don't search the rows in between just to extend the cache
+            result = self.table.getWhereList(
+                condition, variables, start, stop, 0)
+        else:
+            if stop > covered:
+                # The ordering of rows is not guaranteed, but each new
+                # piece follows all cached rows so sorting it keeps the
+                # cached list sorted
+                rows.extend(sorted(self.table.getWhereList(
+                            condition, variables, covered, stop, 0)))
+                covered = stop
+            result = rows[bisect_left(rows, start):bisect_left(rows, stop)]
+
+        self._whereCache[key] = (covered, rows)
+        while len(self._whereCache) > self.whereCacheSize:
+            self._whereCache.popitem(last=False)
+        return result
+
+
     def chunkedRead(self, colNumbers, start, stop, chunk):
         """
         Split a call to table.read(), into multiple chunks to limit the number
@@ -218,6 +337,290 @@ class TableConnection(object):
         return data
 
 
+    def iterRead(self, colNumbers, start, stop, chunk, prefetch = 1):
+        """
+        Read a range of rows in chunks, keeping up to prefetch chunk reads
+        in flight on a worker thread while the caller processes the current
+        chunk.
+        @param colNumbers A list of columns indices to be read
+        @param start The first row to be read
+        @param stop The last + 1 row to be read
+        @param chunk The maximum number of rows to read in each call
+        @param prefetch The number of chunks to read ahead, if 0 chunks are
+        read in the calling thread when requested
+        @return a generator of (first row, data object) for each chunk
+        """
+        ranges = [(p, min(p + chunk, stop)) for p in xrange(start, stop, chunk)]
+        if prefetch < 1:
+            for (p, q) in ranges:
+                yield p, self.table.read(colNumbers, p, q)
+            return
+
+        table = self.table
+        chunks = Queue.Queue(maxsize=prefetch)
+        cancelled = threading.Event()
+
+        def put(item):
+            while not cancelled.is_set():
+                try:
+                    chunks.put(item, timeout=0.1)
+                    return
+                except Queue.Full:
+                    pass
+
+        def reader():
+            try:
+                for (p, q) in ranges:
+                    if cancelled.is_set():
+                        return
+                    put((p, table.read(colNumbers, p, q), None))
+                put((None, None, None))
+            except Exception:
+                put((None, None, sys.exc_info()))
+
+        thread = threading.Thread(target=reader, name='TableConnection.iterRead')
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                p, data, error = chunks.get()
+                if error:
+                    raise error[0], error[1], error[2]
+                if data is None:
+                    break
+                yield p, data
+        finally:
+            cancelled.set()
+            thread.join()
+
+
+    def pipelinedRead(self, colNumbers, start, stop, chunk, prefetch = 1,
+                      asarrays = False):
+        """
+        Equivalent to chunkedRead, but reads ahead on a worker thread (see
+        iterRead) and merges each chunk into output buffers preallocated for
+        stop - start rows.
+        @param colNumbers A list of columns indices to be read
+        @param start The first row to be read
+        @param stop The last + 1 row to be read
+        @param chunk The maximum number of rows to read in each call
+        @param prefetch The number of chunks to read ahead
+        @param asarrays If True the values of each column and the row numbers
+        will be numpy arrays instead of lists
+        @return a data object, note lastModified will be set to the timestamp
+        the first chunked call
+        """
+        n = max(stop - start, 0)
+        data = None
+        m = 0
+        for (p, d) in self.iterRead(colNumbers, start, stop, chunk, prefetch):
+            if data is None:
+                data = d
+                if asarrays:
+                    rowNumbers = numpy.empty(n, dtype=numpy.int64)
+                    values = [self._allocateColumn(c, n) for c in d.columns]
+                else:
+                    rowNumbers = [None] * n
+                    values = [[None] * n for c in d.columns]
+
+            k = len(d.rowNumbers)
+            rowNumbers[m:(m + k)] = d.rowNumbers
+            for (v, c) in izip(values, d.columns):
+                v[m:(m + k)] = c.values
+            m += k
+
+        if data is None:
+            data = self.table.read(colNumbers, start, start)
+            if asarrays:
+                data.rowNumbers = numpy.empty(0, dtype=numpy.int64)
+                for c in data.columns:
+                    c.values = self._allocateColumn(c, 0)
+            return data
+
+        if m < n:
+            # The table has fewer rows than requested
+            rowNumbers = rowNumbers[:m]
+            values = [v[:m] for v in values]
+        data.rowNumbers = rowNumbers
+        for (c, v) in izip(data.columns, values):
+            c.values = v
+        return data
+
+
+    def _allocateColumn(self, col, n):
+        """
+        Internal helper method, creates an uninitialised numpy array large
+        enough to hold n rows of a column
+        @param col The column
+        @param n The number of rows
+        @return an ndarray
+        """
+        if isinstance(col, DoubleArrayColumn):
+            return numpy.empty((n, col.size), dtype=numpy.float64)
+        if isinstance(col, LongArrayColumn):
+            return numpy.empty((n, col.size), dtype=numpy.int64)
+        if isinstance(col, LongColumn):
+            return numpy.empty(n, dtype=numpy.int64)
+        if isinstance(col, DoubleColumn):
+            return numpy.empty(n, dtype=numpy.float64)
+        if isinstance(col, BoolColumn):
+            return numpy.empty(n, dtype=bool)
+        return numpy.empty(n, dtype=object)
+
+
+
+class FeatureArray(object):
+    """
+    A feature table column held as numpy arrays instead of lists
+    """
+
+    def __init__(self, name, values, valid):
+        """
+        @param name The column name
+        @param values A 2-D ndarray (rows x size) for array columns, or a
+        1-D ndarray for scalar columns. Null rows contain zeros.
+        @param valid A 1-D boolean ndarray, False where a row is null
+        """
+        self.name = name
+        self.values = values
+        self.valid = valid
+
+    def masked(self):
+        """
+        @return the values as a numpy masked array, with null rows masked
+        """
+        mask = numpy.logical_not(self.valid)
+        if self.values.ndim == 2:
+            mask = numpy.repeat(mask[:, numpy.newaxis],
+                                self.values.shape[1], axis=1)
+        return numpy.ma.MaskedArray(self.values, mask=mask)
+
+
+class FeatureTableSchema(object):
+    """
+    Cached description of a feature table, obtained from a single call to
+    table.getHeaders() (or from the columns used to create the table).
+    The schema of an OMERO.table never changes once it has been initialised
+    so this can be kept for as long as the table is open.
+
+    Also handles the encoding of the validity indicator columns for the
+    table layout:
+    LAYOUT_BOOL: A '_b_' BoolColumn for each data column
+    LAYOUT_PACKED: One or more '_v_' LongColumns, bit i % 64 of column
+    i / 64 is set if data column i is valid. The layout version is recorded
+    in the description of these columns.
+    """
+
+    # Prefix and description of the LAYOUT_PACKED bitmask columns
+    packedPrefix = '_v_'
+    packedDescription = 'layout:%d' % LAYOUT_PACKED
+    packedBits = 64
+
+    def __init__(self, headers):
+        """
+        @param headers The full list of table columns, including the
+        indicator columns
+        """
+        self.headers = deepcopy(headers)
+        for h in self.headers:
+            h.values = None
+
+        if self.headers[-1].name.startswith(self.packedPrefix):
+            self.layout = LAYOUT_PACKED
+            self.nCols = len([h for h in self.headers if
+                              not h.name.startswith(self.packedPrefix)])
+            for h in self.headers[self.nCols:]:
+                if h.description != self.packedDescription:
+                    raise TableConnectionError(
+                        "Unsupported table layout: %s" % h.description)
+        else:
+            self.layout = LAYOUT_BOOL
+            self.nCols = len(self.headers) / 2
+
+        self.names = [h.name for h in self.headers]
+        self.types = [type(h) for h in self.headers]
+        self.sizes = [getattr(h, 'size', None) for h in self.headers]
+        self.idColName = self.names[0]
+        self.index = dict((n, i) for (i, n) in
+                          enumerate(self.names[:self.nCols]))
+
+    def dataHeaders(self):
+        """
+        @return a list of empty data columns (including the id column)
+        """
+        return deepcopy(self.headers[:self.nCols])
+
+    def newHeaders(self):
+        """
+        @return a list of all empty columns, data followed by indicators
+        """
+        return deepcopy(self.headers)
+
+    @classmethod
+    def indicatorHeaders(cls, names, layout):
+        """
+        Create the indicator columns for a new table
+        @param names The names of the data columns
+        @param layout The table layout
+        @return a list of empty columns
+        """
+        if layout == LAYOUT_BOOL:
+            return [BoolColumn('_b_' + name) for name in names]
+        if layout == LAYOUT_PACKED:
+            nWords = (len(names) + cls.packedBits - 1) / cls.packedBits
+            return [LongColumn('%s%d' % (cls.packedPrefix, w),
+                               cls.packedDescription)
+                    for w in xrange(nWords)]
+        raise TableConnectionError("Invalid table layout: %s" % layout)
+
+    def indicatorColumns(self, colNumbers):
+        """
+        @param colNumbers A list of data column numbers
+        @return the indicator column numbers which must be read to determine
+        the validity of colNumbers
+        """
+        if self.layout == LAYOUT_BOOL:
+            return [c + self.nCols for c in colNumbers]
+        return sorted(set(c / self.packedBits + self.nCols
+                          for c in colNumbers))
+
+    def decodeValidity(self, colNumbers, indicators):
+        """
+        @param colNumbers A list of data column numbers
+        @param indicators The indicator columns read from the table, as
+        returned by indicatorColumns(colNumbers)
+        @return a list of boolean lists or arrays, indicating whether
+        each data column is valid in each row
+        """
+        if self.layout == LAYOUT_BOOL:
+            return [b.values for b in indicators]
+
+        words = dict(
+            (c, numpy.asarray(b.values, dtype=numpy.int64)) for (c, b) in
+            izip(self.indicatorColumns(colNumbers), indicators))
+        return [((words[c / self.packedBits + self.nCols] >>
+                  (c % self.packedBits)) & 1).astype(bool)
+                for c in colNumbers]
+
+    def encodeValidity(self, valid):
+        """
+        @param valid A list of boolean lists or arrays, indicating whether
+        each data column is valid in each row, for all data columns
+        @return a list of values for each indicator column
+        """
+        if self.layout == LAYOUT_BOOL:
+            return [v.tolist() if isinstance(v, numpy.ndarray) else v
+                    for v in valid]
+
+        nRows = len(valid[0])
+        words = []
+        for w in xrange(0, self.nCols, self.packedBits):
+            word = numpy.zeros(nRows, dtype=numpy.int64)
+            for (b, v) in enumerate(valid[w:(w + self.packedBits)]):
+                word |= numpy.asarray(v, dtype=numpy.int64) << b
+            words.append(word.tolist())
+        return words
+
 
 class FeatureTableConnection(TableConnection):
     """
@@ -226,41 +629,90 @@ class FeatureTableConnection(TableConnection):
     Also allow within-array selections.
 
     Internally this uses an addition set of BoolColumns to indicate whether
-    a column contains valid data (True) or is null (False)
+    a column contains valid data (True) or is null (False). Alternatively
+    the validity flags can be packed into LongColumn bitmasks, see
+    FeatureTableSchema.
 
-    @todo Cache some of the metadata (e.g. column names) instead of
-    requesting every time
+    The table headers are cached in a FeatureTableSchema when the table is
+    opened or created, and discarded when it is closed.
     """
 
+    # The number of rows read in each call when building the id index
+    idIndexChunk = 100000
+
+    # The default number of rows in each block of a zone map
+    zoneMapBlockSize = 10000
+
     def __init__(self, user = None, passwd = None, host = None,
-                 client = None, tableName = None, tableId = None):
+                 client = None, tableName = None, tableId = None,
+                 localDir = None, sinks = None):
         """
         Just calls the base-class constructor
         """
         super(FeatureTableConnection, self).__init__(
-            user, passwd, host, client, tableName, tableId = None)
+            user, passwd, host, client, tableName, tableId = None,
+            localDir = localDir, sinks = sinks)
+        self._blockCache = None
+        self._zoneMapEnabled = False
+        self._resetTableCaches()
 
-    def createNewTable(self, idcolName, colDescriptions):
+
+    def openTable(self, tableId = None, tableName = None):
+        """
+        Opens an existing table by ID or name, and caches its schema
+        See TableConnection.openTable
+        """
+        self._schema = None
+        table = super(FeatureTableConnection, self).openTable(
+            tableId, tableName)
+        self._schema = FeatureTableSchema(table.getHeaders())
+        return table
+
+
+    def closeTable(self):
+        """
+        Close the table if open and discard the cached schema and indices
+        """
+        try:
+            if self._zoneMap:
+                self._zoneMap.close()
+        finally:
+            self._resetTableCaches()
+            super(FeatureTableConnection, self).closeTable()
+
+
+    def newTable(self, schema):
+        """
+        Create a new uninitialised table, and cache its schema
+        See TableConnection.newTable
+        """
+        table = super(FeatureTableConnection, self).newTable(schema)
+        self._schema = FeatureTableSchema(schema)
+        return table
+
+    def createNewTable(self, idcolName, colDescriptions, layout = LAYOUT_BOOL):
         """
         Create a new table with an id LongColumn followed by
         a set of nullable DoubleArrayColumns
         @param idcolName The name of the id LongColumn
         @param colDescriptions A list of 2-tuples describing each column in
         the form [(name, size), ...]
+        @param layout LAYOUT_BOOL to use a BoolColumn to indicate the
+        validity of each column, or LAYOUT_PACKED to pack all validity
+        flags for a row into LongColumn bitmasks
         """
 
-        # Create an identical number of bool columns indicating whether
+        # Create indicator columns for every column indicating whether
         # columns are valid or not. To make things easier this includes
-        # a bool column for the id column even though it should always
-        # be valid.
+        # the id column even though it should always be valid.
 
 
         cols = [LongColumn(idcolName)] + \
             [DoubleArrayColumn(name, '', size) \
                  for (name, size) in colDescriptions] + \
-                 [BoolColumn('_b_' + idcolName)] + \
-                 [BoolColumn('_b_' + name) \
-                      for (name, size) in colDescriptions]
+            FeatureTableSchema.indicatorHeaders(
+                [idcolName] + [name for (name, size) in colDescriptions],
+                layout)
         self.newTable(cols)
 
 
@@ -273,64 +725,328 @@ class FeatureTableConnection(TableConnection):
         @return A list of BoolColumns indicating whether the corresponding
         row-column element is valid (True) or null (False).
         """
-        nCols = self._checkColNumbers(colNumbers)
-        bcolNumbers = map(lambda x: x + nCols, colNumbers)
-        data = self.table.read(bcolNumbers, start, stop)
-        return data.columns
+        self._checkColNumbers(colNumbers)
+        schema = self._schema
+        data = self.table.read(
+            schema.indicatorColumns(colNumbers), start, stop)
+        if schema.layout == LAYOUT_BOOL:
+            return data.columns
 
+        valid = schema.decodeValidity(colNumbers, data.columns)
+        return [BoolColumn('_b_' + schema.names[c], '', v.tolist())
+                for (c, v) in izip(colNumbers, valid)]
 
-    def readSubArray(self, colArrayNumbers, start, stop):
+
+    def readSubArray(self, colArrayNumbers, start, stop, result = COLUMNS,
+                     chunk = None, prefetch = 1):
         """
         Read the requested array columns and indices from the table
         @param colArrayNumbers A dictionary mapping column numbers to
         an array of subindices e.g. {1:[1,3], 3:[0]}
         @param start The first row to be read
         @param stop The last + 1 row to be read
+        @param result The format of the returned columns, one of COLUMNS,
+        NDARRAY or MASKED, see readArray
+        @param chunk If set the rows will be read in chunks of this size,
+        see TableConnection.pipelinedRead
+        @param prefetch The number of chunks to read ahead if chunk is set
         @return A list of columns with the requested array elements, which
         may be empty (null). If the id column is requested this will not be
         an array.
         """
-
+        self._checkResultFormat(result)
         colNumbers = colArrayNumbers.keys()
         subIndices = colArrayNumbers.values()
-        nCols = self._checkColNumbers(colNumbers)
-        nWanted = len(colNumbers)
-
-        bcolNumbers = map(lambda x: x + nCols, colNumbers)
-        data = self.table.read(colNumbers + bcolNumbers, start, stop)
-        columns = data.columns
+        self._checkColNumbers(colNumbers)
+        if self._blockCache:
+            return self._readCached(
+                colNumbers, start, stop, result, subIndices)
 
-        for (c, b, s) in izip(columns[:nWanted], columns[nWanted:], subIndices):
-            #indexer = opertor.itemgetter(*s)
-            if isinstance(c, (LongArrayColumn, DoubleArrayColumn)):
-                c.values = [[x[i] for i in s] if y else []
-                            for (x, y) in izip(c.values, b.values)]
-            else:
-                self._nullEmptyColumns(c, b)
+        data = self._readRows(
+            colNumbers + self._schema.indicatorColumns(colNumbers),
+            start, stop, result, chunk, prefetch)
+        return self._formatColumns(
+            colNumbers, data.columns, result, subIndices)
 
-        return columns[:nWanted]
 
-
-    def readArray(self, colNumbers, start, stop):
+    def readArray(self, colNumbers, start, stop, result = COLUMNS,
+                  chunk = None, prefetch = 1):
         """
         Read the requested array columns which may include null entries
         @param colNumbers Column numbers
         @param start The first row to be read
         @param stop The last + 1 row to be read
+        @param result The format of the returned columns:
+        COLUMNS: OMERO columns, null arrays are [] and null scalars None
+        NDARRAY: FeatureArrays holding a 2-D (or 1-D for scalar columns)
+        ndarray of values and a boolean validity vector
+        MASKED: numpy masked arrays in which null rows are masked
+        @param chunk If set the rows will be read in chunks of this size,
+        see TableConnection.pipelinedRead
+        @param prefetch The number of chunks to read ahead if chunk is set
         @return a list of columns
         """
+        self._checkResultFormat(result)
+        self._checkColNumbers(colNumbers)
+        if self._blockCache:
+            return self._readCached(colNumbers, start, stop, result)
 
-        nCols = self._checkColNumbers(colNumbers)
-        nWanted = len(colNumbers)
+        data = self._readRows(
+            colNumbers + self._schema.indicatorColumns(colNumbers),
+            start, stop, result, chunk, prefetch)
+        return self._formatColumns(colNumbers, data.columns, result)
+
+
+    def iterChunks(self, colNumbers, start = 0, stop = None, chunk = 1000,
+                   result = COLUMNS, prefetch = 1):
+        """
+        Iterate over a range of rows in chunks, so that a whole table can be
+        processed with bounded memory
+        @param colNumbers A list of column numbers, or a dictionary mapping
+        column numbers to an array of subindices as in readSubArray
+        @param start The first row to be read
+        @param stop The last + 1 row to be read, default is the end of the
+        table
+        @param chunk The maximum number of rows in each chunk
+        @param result The format of the returned columns, see readArray
+        @param prefetch The number of chunks to read ahead, see
+        TableConnection.iterRead
+        @return a generator of (first row, columns) for each chunk
+        """
+        self._checkResultFormat(result)
+        if isinstance(colNumbers, dict):
+            subIndices = colNumbers.values()
+            colNumbers = colNumbers.keys()
+        else:
+            subIndices = None
+        self._checkColNumbers(colNumbers)
+        if stop is None:
+            stop = self.getNumberOfRows()
+
+        readColNumbers = colNumbers + \
+            self._schema.indicatorColumns(colNumbers)
+        for (p, data) in self.iterRead(
+            readColNumbers, start, stop, chunk, prefetch):
+            yield p, self._formatColumns(
+                colNumbers, data.columns, result, subIndices)
+
+
+    def exportArchive(self, path, start = 0, stop = None, chunk = 10000,
+                      resume = False, compress = False, progress = None,
+                      prefetch = 1):
+        """
+        Export a range of rows to an HDF5 or npz archive, see FeatureArchive.
+        The table is read in chunks with prefetching, so memory use is
+        bounded for HDF5 archives (npz archives are held in memory until
+        they are written).
+        @param path The archive file name, the extension determines the
+        format
+        @param start The first row to be exported
+        @param stop The last + 1 row to be exported, default is the end of
+        the table
+        @param chunk The number of rows read in each call
+        @param resume If True and path is an HDF5 archive written by an
+        interrupted export starting at the same row, continue after the last
+        archived row
+        @param compress If True compress the archive
+        @param progress An optional function called after each chunk as
+        progress(rows exported, total rows)
+        @param prefetch The number of chunks to read ahead
+        @return the number of rows in the archive
+        """
+        from FeatureArchive import ArchiveWriter
+        schema = self._getSchema()
+        colNumbers = range(schema.nCols)
+        columns = [(schema.idColName, None)]
+        for c in colNumbers[1:]:
+            if schema.types[c] not in (DoubleArrayColumn, LongArrayColumn):
+                raise TableConnectionError(
+                    'Only array columns can be exported: %s' %
+                    schema.names[c])
+            columns.append((schema.names[c], schema.sizes[c]))
+        if stop is None:
+            stop = self.getNumberOfRows()
+        total = stop - start
+
+        w = ArchiveWriter(path, columns, compress=compress, resume=resume,
+                          start=start, expectedRows=total)
+        try:
+            if w.start != start:
+                raise TableConnectionError(
+                    'Archive %s starts at row %d not %d' %
+                    (path, w.start, start))
+            done = w.rows()
+            if done > total:
+                raise TableConnectionError(
+                    'Archive %s has more than %d rows' % (path, total))
+            if done:
+                log.info('Resuming export to %s at row %d', path,
+                         start + done)
+
+            for (p, arrays) in self.iterChunks(
+                colNumbers, start + done, stop, chunk, NDARRAY, prefetch):
+                w.append(dict((a.name, a.values) for a in arrays),
+                         dict((a.name, a.valid) for a in arrays[1:]))
+                done = p + len(arrays[0].valid) - start
+                log.debug('Exported %d/%d rows to %s', done, total, path)
+                if progress:
+                    progress(done, total)
+        finally:
+            w.close()
+        return w.rows()
+
+
+    def importArchives(self, paths, batch = 100000, processes = None,
+                       checkpoint = None, progress = None):
+        """
+        Append the rows of a list of archives to the table, reading and
+        converting them on a pool of worker processes, see
+        FeatureImport.importArchives
+        @return the number of rows imported
+        """
+        from FeatureImport import importArchives
+        return importArchives(self, paths, batch, processes, checkpoint,
+                              progress)
+
+
+    def query(self, predicate, start = 0, stop = None, chunk = 10000,
+              count = False, prefetch = 1):
+        """
+        Find the rows matching a predicate built from FeatureQuery.Feature,
+        using a chunked scan in which only the columns referenced by the
+        predicate are read
+        @param predicate A FeatureQuery.Predicate, e.g.
+        Feature('f1').all() > 1
+        @param start The first row to be searched
+        @param stop The last + 1 row to be searched, default is the end of
+        the table
+        @param chunk The number of rows read in each call
+        @param count If True return the number of matching rows instead of
+        their indices
+        @param prefetch The number of chunks to read ahead
+        @return a list of matching row indices, or the number of matching
+        rows if count is True
+        """
+        schema = self._getSchema()
+        names = sorted(predicate.columns())
+        try:
+            colNumbers = [schema.index[n] for n in names]
+        except KeyError as e:
+            raise TableConnectionError("Unknown column: %s" % e.args[0])
+        if stop is None:
+            stop = self.getNumberOfRows()
+
+        # Skip blocks which cannot match if the zone map is enabled, rows
+        # which are not in a complete block of the companion table are
+        # always scanned
+        ranges = [(start, stop)]
+        zoneMap = self._getZoneMap()
+        if zoneMap:
+            zoneMap.refresh()
+            ranges = zoneMap.candidateRanges(predicate, start, stop)
+
+        nMatches = 0
+        rows = []
+        for (rangeStart, rangeStop) in ranges:
+            for (p, arrays) in self.iterChunks(
+                colNumbers, rangeStart, rangeStop, chunk, NDARRAY, prefetch):
+                match = predicate.evaluate(dict(izip(names, arrays)))[0]
+                if count:
+                    nMatches += numpy.count_nonzero(match)
+                else:
+                    rows.extend((numpy.flatnonzero(match) + p).tolist())
+        if count:
+            return nMatches
+        return rows
+
+
+    def createZoneMap(self, blockSize = None):
+        """
+        Create a zone map for the open table, summarising the rows already in
+        the table, and enable it on this connection. The zone map is stored
+        in a companion table and is used by query() to skip blocks of rows.
+        It is updated when rows are added by any FeatureTableConnection
+        which has enabled it, see enableZoneMap() and ZoneMap.
+        @param blockSize The number of rows in each block, default is
+        zoneMapBlockSize
+        """
+        from ZoneMap import ZoneMap
+        if self._findZoneMap():
+            raise TableConnectionError("Table already has a zone map")
+        schema = self._getSchema()
+        self._zoneMap = ZoneMap.create(
+            self.res, self.rid, self.table.getOriginalFile(),
+            schema.names[:schema.nCols], blockSize or self.zoneMapBlockSize)
+        self._zoneMapEnabled = True
+        self._updateZoneMap()
+
+
+    def deleteZoneMap(self):
+        """
+        Delete the zone map of the open table if it exists
+        """
+        if self._findZoneMap():
+            self._zoneMap.delete()
+            self._zoneMap = None
+
+
+    def enableZoneMap(self):
+        """
+        Use the zone map of a table, if it has one, to skip blocks of rows
+        in query(), and update it when rows are added by this connection.
+        This applies to all tables opened by this connection. Tables are
+        only checked for a zone map when it is enabled, so connections
+        which don't use zone maps don't pay for looking them up.
+        """
+        self._zoneMapEnabled = True
+
+
+    def disableZoneMap(self):
+        """
+        Stop using and updating zone maps, the zone map of the open table is
+        closed but not deleted
+        """
+        self._zoneMapEnabled = False
+        if self._zoneMap:
+            self._zoneMap.close()
+        self._zoneMap = None
+        self._zoneMapChecked = False
+
+
+    def enableBlockCache(self, maxBytes = 256 * 1024 * 1024,
+                         blockSize = 1000):
+        """
+        Cache the rows read by readArray and readSubArray, so that repeated
+        reads of overlapping rows are served from memory. Rows are read and
+        cached in aligned blocks of blockSize rows for each column, full
+        arrays are always cached so sub-array selections can be served from
+        the cache. chunk and prefetch are ignored when the cache is enabled.
+        The last incomplete block is discarded when the number of rows in
+        the table changes, and the cache is cleared when the table is
+        closed. See BlockCache.
+        @param maxBytes The maximum size of the cache, least recently used
+        blocks are evicted first
+        @param blockSize The number of rows in each block
+        """
+        from BlockCache import BlockCache
+        self._blockCache = BlockCache(maxBytes, blockSize)
 
-        bcolNumbers = map(lambda x: x + nCols, colNumbers)
-        data = self.table.read(colNumbers + bcolNumbers, start, stop)
-        columns = data.columns
 
-        for (c, b) in izip(columns[:nWanted], columns[nWanted:]):
-            self._nullEmptyColumns(c, b)
+    def disableBlockCache(self):
+        """
+        Disable and discard the block cache
+        """
+        self._blockCache = None
+
 
-        return columns[:nWanted]
+    def blockCacheStats(self):
+        """
+        @return a dictionary with the hits, misses, evictions, blocks and
+        bytes of the block cache, or None if it is not enabled
+        """
+        if self._blockCache:
+            return self._blockCache.stats()
+        return None
 
 
     def getRowId(self, id):
@@ -340,18 +1056,22 @@ class FeatureTableConnection(TableConnection):
         @return the row index of the object, if the object is present in
         multiple rows returns the highest row index, or None if not found
         """
-        columns = self.table.getHeaders()
-        nrows = self.getNumberOfRows()
-        condition = '(%s==%d)' % (columns[0].name, id)
-        idx = self.table.getWhereList(condition=condition, variables={},
-                                      start=0, stop=nrows, step=0)
+        return self.getRowIds([id])[0]
 
-        if not idx:
-            return None
-        if len(idx) > 1:
-            print "Multiple rows found, returning last"
-            # Ordering of rows not guaranteed
-        return max(idx)
+
+    def getRowIds(self, ids):
+        """
+        Find the row indices corresponding to a list of ids using a
+        client-side index of the id column. The index is built on first use
+        with a single streaming read of the id column, and is updated with
+        any rows which have been added since.
+        @param ids a list of ids of the objects to be retrieved
+        @return a list of row indices, if an object is present in multiple
+        rows the highest row index is used, or None if not found
+        """
+        self._updateIdIndex()
+        get = self._idIndex.get
+        return [get(id) for id in ids]
 
 
     def getHeaders(self):
@@ -359,8 +1079,7 @@ class FeatureTableConnection(TableConnection):
         Get a set of columns to be used for populating the table with data
         @return a list of empty columns
         """
-        columns = self.table.getHeaders()
-        return columns[:(len(columns) / 2)]
+        return self._getSchema().dataHeaders()
 
 
     def getNumberOfRows(self):
@@ -371,14 +1090,16 @@ class FeatureTableConnection(TableConnection):
         return self.table.getNumberOfRows()
 
 
-    def addData(self, cols, copy=True):
+    def addData(self, cols, copy = None):
         """
         Add a new row of data where DoubleArrays may be null
         @param cols A list of columns obtained from getHeaders() whose values
         have been filled with the data to be added.
+        @param copy Deprecated and ignored, the input columns are never
+        modified
         """
-        columns = self.table.getHeaders()
-        nCols = len(columns) / 2
+        self._checkCopy(copy)
+        nCols = self._getSchema().nCols
         if len(cols) != nCols:
             raise TableConnectionError(
                 "Expected %d columns, got %d" % (nCols, len(cols)))
@@ -388,93 +1109,475 @@ class FeatureTableConnection(TableConnection):
             raise TableConnectionError(
                 "Expected 1 LongColumn and %d DoubleArrayColumn" % (nCols - 1))
 
-        if copy:
-            columns[:nCols] = deepcopy(cols)
-        else:
-            columns[:nCols] = cols
-
-        # Handle first ID column separately, it is not a DoubleArray
-        columns[nCols].values = [True] * len(cols[0].values)
-        for (c, b) in izip(columns[1:nCols], columns[(nCols + 1):]):
-            emptyval = [0.0] * c.size
-            # bool([])==false
-            b.values = [bool(x) for x in c.values]
-            c.values = [x if x else emptyval for x in c.values]
-
-        self.table.addData(columns)
+        self._addColumns(cols)
 
 
-    def addPartialData(self, cols, copy=True):
+    def addPartialData(self, cols, copy = None):
         """
         Add a new row of data where some DoubleArray columns may be omitted
         @param cols A subset of the columns obtained from getHeaders() whose
         values have been filled with the data to be added. Missing columns
         are automatically treated as nulls.
+        @param copy Deprecated and ignored, the input columns are never
+        modified
         """
-        columns = self.table.getHeaders()
-        nCols = len(columns) / 2
+        self._checkCopy(copy)
+        self._addColumns(cols)
 
-        if copy:
-            cols = deepcopy(cols)
-        columnMap = dict([(c.name, c) for c in cols])
+
+    def addArrays(self, arrays, valid = None):
+        """
+        Add rows of data held in numpy arrays. The input arrays are not
+        modified.
+        @param arrays A dictionary mapping column names to arrays. The id
+        column must be given as a 1-D array, DoubleArray columns as 2-D
+        arrays (rows x size). Missing columns are treated as nulls.
+        @param valid An optional dictionary mapping column names to 1-D
+        boolean arrays indicating whether each row is valid (True) or null
+        (False). Columns without an entry are valid in every row.
+        """
+        self._appendColumns(self._arraysToColumns(arrays, valid))
+        if self._getZoneMap():
+            self._updateZoneMap(self._arraysToFeatureArrays(arrays, valid))
+
+
+    def _checkCopy(self, copy):
+        """
+        Internal helper method, warns if the deprecated copy argument of
+        addData or addPartialData was given
+        """
+        if copy is not None:
+            warnings.warn(
+                'copy is deprecated and ignored, the input columns are never '
+                'modified', DeprecationWarning, stacklevel=3)
+
+
+    def _addColumns(self, cols):
+        """
+        Internal helper method, adds a list of data columns in which null
+        arrays are []. Lists are converted directly, which is faster than
+        converting them to arrays for small inserts, unless the values are
+        already arrays or the rows must be summarised for the zone map.
+        @param cols A list of columns
+        """
+        if self._getZoneMap() or any(
+            isinstance(c.values, numpy.ndarray) for c in cols):
+            self.addArrays(*self._columnsToArrays(cols))
+        else:
+            self._appendColumns(self._listsToColumns(cols))
+
+
+    def _appendColumns(self, columns):
+        """
+        Internal helper method, adds a full set of data and indicator
+        columns to the table and updates the cached information about the
+        table
+        @param columns A list of columns
+        """
+        self.table.addData(columns)
+        if self._idIndex is not None:
+            self._idPending.append(columns[0].values)
+        if self._blockCache:
+            self._blockCache.invalidatePartial()
+
+
+    def _columnsToArrays(self, cols):
+        """
+        Internal helper method, converts a list of data columns in which null
+        arrays are [] into the arguments expected by addArrays
+        @param cols A list of columns
+        @return a 2-tuple of dictionaries (arrays, valid)
+        """
+        idColName = self._getSchema().idColName
+        arrays = {}
+        valid = {}
+        for c in cols:
+            if c.name == idColName:
+                arrays[c.name] = c.values
+                continue
+            if not isinstance(c, DoubleArrayColumn):
+                raise TableConnectionError(
+                    "Expected DoubleArrayColumn (%s)" % c.name)
+
+            # bool([])==false
+            v = numpy.array(map(bool, c.values), dtype=bool)
+            if v.all():
+                a = c.values
+            else:
+                a = numpy.zeros((len(v), c.size))
+                if v.any():
+                    try:
+                        a[v] = list(compress(c.values, v))
+                    except ValueError as e:
+                        raise TableConnectionError(
+                            "Invalid data for column %s: %s" % (c.name, e))
+                valid[c.name] = v
+            arrays[c.name] = a
+
+        return arrays, valid
+
+
+    def _listsToColumns(self, cols):
+        """
+        Internal helper method, converts a list of data columns in which null
+        arrays are [] into a full set of data and indicator columns ready to
+        be added to the table, without converting the values to arrays
+        @param cols A list of columns
+        @return a list of columns
+        """
+        schema = self._getSchema()
+        nCols = schema.nCols
+        columns = schema.newHeaders()
+        columnMap = dict((c.name, c) for c in cols)
+
+        unexpected = set(columnMap.keys()).difference(schema.index.keys())
+        if unexpected:
+            raise TableConnectionError(
+                "Unexpected columns: %s" % sorted(unexpected))
 
         # Check the first id column is present
-        idColName = columns[0].name
         try:
-            columns[0] = columnMap.pop(idColName)
+            ids = columnMap[schema.idColName].values
         except KeyError:
             raise TableConnectionError(
-                "First column (%s) must be provided" % idCol.name)
+                "First column (%s) must be provided" % schema.idColName)
 
-        nRows = len(columns[0].values)
-        columns[nCols].values = [True] * nRows
+        # Copied since the ids are kept for the id index, and the caller may
+        # reuse the list
+        nRows = len(ids)
+        columns[0].values = list(ids)
+        validity = [[True] * nRows]
 
-        for n in xrange(1, nCols):
+        for c in columns[1:nCols]:
             try:
-                columns[n] = columnMap.pop(columns[n].name)
-                self._zeroEmptyColumns(columns[n], columns[nCols + n])
+                col = columnMap[c.name]
             except KeyError:
-                columns[n].values = [[0.0] * columns[n].size] * nRows
-                columns[nCols + n].values = [False] * nRows
+                c.values = [[0.0] * c.size] * nRows
+                validity.append([False] * nRows)
+                continue
 
-            if not isinstance(columns[n], DoubleArrayColumn):
+            if not isinstance(col, DoubleArrayColumn):
+                raise TableConnectionError(
+                    "Expected DoubleArrayColumn (%s)" % c.name)
+            if len(col.values) != nRows:
                 raise TableConnectionError(
-                    "Expected DoubleArrayColumn (%s)" % columns[n].name)
+                    "Expected %d rows for column %s, got %d" %
+                    (nRows, c.name, len(col.values)))
+
+            # bool([])==false
+            v = [bool(x) for x in col.values]
+            if any(len(x) != c.size for x in compress(col.values, v)):
+                raise TableConnectionError(
+                    "Expected size %d for column %s" % (c.size, c.name))
+            if all(v):
+                c.values = col.values
+            else:
+                emptyval = [0.0] * c.size
+                c.values = [x if x else emptyval for x in col.values]
+            validity.append(v)
 
-        if columnMap.keys():
+        for (b, v) in izip(columns[nCols:], schema.encodeValidity(validity)):
+            b.values = v
+        return columns
+
+
+    def _arraysToColumns(self, arrays, valid):
+        """
+        Internal helper method, converts the arguments of addArrays into a
+        full set of data and indicator columns ready to be added to the table
+        @param arrays A dictionary mapping column names to arrays
+        @param valid A dictionary mapping column names to boolean arrays,
+        or None
+        @return a list of columns
+        """
+        schema = self._getSchema()
+        nCols = schema.nCols
+        columns = schema.newHeaders()
+        if valid is None:
+            valid = {}
+
+        unexpected = set(arrays.keys()).union(valid.keys()).difference(
+            schema.index.keys())
+        if unexpected:
             raise TableConnectionError(
-                "Unexpected columns: %s" % columnMap.keys())
+                "Unexpected columns: %s" % sorted(unexpected))
 
-        self.table.addData(columns)
+        # Check the first id column is present
+        try:
+            ids = numpy.asarray(arrays[schema.idColName], dtype=numpy.int64)
+        except KeyError:
+            raise TableConnectionError(
+                "First column (%s) must be provided" % schema.idColName)
+        if ids.ndim != 1:
+            raise TableConnectionError(
+                "Expected 1-D array for column %s" % schema.idColName)
+
+        nRows = len(ids)
+        columns[0].values = ids.tolist()
+        validity = [[True] * nRows]
 
+        for c in columns[1:nCols]:
+            if not isinstance(c, DoubleArrayColumn):
+                raise TableConnectionError(
+                    "Expected DoubleArrayColumn (%s)" % c.name)
 
-    def _zeroEmptyColumns(self, col, bcol):
+            try:
+                a = arrays[c.name]
+            except KeyError:
+                c.values = [[0.0] * c.size] * nRows
+                validity.append([False] * nRows)
+                continue
+
+            try:
+                a = numpy.asarray(a, dtype=numpy.float64)
+            except ValueError as e:
+                raise TableConnectionError(
+                    "Invalid data for column %s: %s" % (c.name, e))
+            if a.shape != (nRows, c.size):
+                raise TableConnectionError(
+                    "Expected shape %s for column %s, got %s" %
+                    ((nRows, c.size), c.name, a.shape))
+
+            try:
+                v = numpy.asarray(valid[c.name], dtype=bool)
+            except KeyError:
+                c.values = a.tolist()
+                validity.append(validity[0])
+                continue
+
+            if v.shape != (nRows,):
+                raise TableConnectionError(
+                    "Expected shape %s for validity of column %s, got %s" %
+                    ((nRows,), c.name, v.shape))
+            if not v.all():
+                a = numpy.where(v[:, numpy.newaxis], a, 0.0)
+            c.values = a.tolist()
+            validity.append(v)
+
+        for (b, v) in izip(columns[nCols:], schema.encodeValidity(validity)):
+            b.values = v
+        return columns
+
+
+    def _arraysToFeatureArrays(self, arrays, valid):
         """
-        Internal helper method, sets empty elements to zeros and the
-        corresponding boolean indicator column entry to False
-        @param col The data column
-        @param bcol The indicator column
+        Internal helper method, converts the arguments of addArrays, which
+        must already have been checked by _arraysToColumns, into
+        FeatureArrays for every data column. Missing columns have no values.
+        @param arrays A dictionary mapping column names to arrays
+        @param valid A dictionary mapping column names to boolean arrays,
+        or None
+        @return a list of FeatureArrays
         """
-        #for (c, b) in izip(columns[1:nCols], columns[(nCols + 1):]):
-        emptyval = [0.0] * col.size
-        bcol.values = [bool(x) for x in col.values]
-        col.values = [x if x else emptyval for x in col.values]
+        schema = self._getSchema()
+        if valid is None:
+            valid = {}
+        ids = numpy.asarray(arrays[schema.idColName], dtype=numpy.int64)
+        nRows = len(ids)
+        result = [FeatureArray(schema.idColName, ids,
+                               numpy.ones(nRows, dtype=bool))]
+        for name in schema.names[1:schema.nCols]:
+            try:
+                a = numpy.asarray(arrays[name], dtype=numpy.float64)
+            except KeyError:
+                result.append(FeatureArray(name, numpy.zeros((nRows, 0)),
+                                           numpy.zeros(nRows, dtype=bool)))
+                continue
+            try:
+                v = numpy.asarray(valid[name], dtype=bool)
+            except KeyError:
+                v = numpy.ones(nRows, dtype=bool)
+            result.append(FeatureArray(name, a, v))
+        return result
 
 
-    def _nullEmptyColumns(self, col, bcol):
+    def _nullEmptyColumns(self, col, valid):
         """
         Internal helper method, sets column elements which are indicated by
         the boolean indicator as empty to [] if they are array-columns, or
         None for scalar column types
         @param col The data column
-        @param bcol The indicator column
+        @param valid The values of the indicator column
         """
         if isinstance(col, (LongArrayColumn, DoubleArrayColumn)):
             col.values = [x if y else []
-                          for (x, y) in izip(col.values, bcol.values)]
+                          for (x, y) in izip(col.values, valid)]
         else:
             col.values = [x if y else None
-                          for (x, y) in izip(col.values, bcol.values)]
+                          for (x, y) in izip(col.values, valid)]
+
+
+    def _readRows(self, colNumbers, start, stop, result, chunk, prefetch):
+        """
+        Internal helper method, reads a range of rows either in a single call
+        or in pipelined chunks
+        @param colNumbers A list of columns indices to be read
+        @param start The first row to be read
+        @param stop The last + 1 row to be read
+        @param result The result format, chunked reads for the numpy formats
+        are merged directly into arrays
+        @param chunk The maximum number of rows to read in each call, or None
+        @param prefetch The number of chunks to read ahead
+        @return a data object
+        """
+        if not chunk:
+            return self.table.read(colNumbers, start, stop)
+        return self.pipelinedRead(colNumbers, start, stop, chunk, prefetch,
+                                  asarrays=(result != COLUMNS))
+
+
+    def _formatColumns(self, colNumbers, columns, result, subIndices = None):
+        """
+        Internal helper method, converts a list of data columns followed by
+        their indicator columns into the requested result format, nulling
+        invalid entries and applying any sub-array selections
+        @param colNumbers The data column numbers
+        @param columns The data columns followed by the indicator columns
+        returned by FeatureTableSchema.indicatorColumns(colNumbers)
+        @param result The result format, COLUMNS, NDARRAY or MASKED
+        @param subIndices Optional list of array sub-indices for each data
+        column, ignored for scalar columns
+        @return a list of columns or arrays
+        """
+        nWanted = len(colNumbers)
+        valid = self._schema.decodeValidity(colNumbers, columns[nWanted:])
+        columns = columns[:nWanted]
+        if subIndices is None:
+            subIndices = [None] * nWanted
+
+        if result == COLUMNS:
+            for (c, v, s) in izip(columns, valid, subIndices):
+                if s is not None and \
+                        isinstance(c, (LongArrayColumn, DoubleArrayColumn)):
+                    c.values = [[x[i] for i in s] if y else []
+                                for (x, y) in izip(c.values, v)]
+                else:
+                    self._nullEmptyColumns(c, v)
+            return columns
+
+        arrays = []
+        for (c, v, s) in izip(columns, valid, subIndices):
+            a = self._toFeatureArray(c, v)
+            if s is not None and a.values.ndim == 2:
+                a.values = a.values[:, s]
+            if result == MASKED:
+                a = a.masked()
+            arrays.append(a)
+        return arrays
+
+
+    def _readCached(self, colNumbers, start, stop, result, subIndices = None):
+        """
+        Internal helper method, reads a range of rows through the block
+        cache. Missing blocks are read from the table, a single read is used
+        for each run of consecutive blocks which are missing the same
+        columns.
+        @param colNumbers The data column numbers
+        @param start The first row to be read
+        @param stop The last + 1 row to be read
+        @param result The result format, COLUMNS, NDARRAY or MASKED
+        @param subIndices Optional list of array sub-indices for each data
+        column
+        @return a list of columns or arrays
+        """
+        cache = self._blockCache
+        bs = cache.blockSize
+        cache.setRows(self.getNumberOfRows())
+        stop = max(min(stop, cache.nrows), start)
+        blockNumbers = range(start / bs, (stop + bs - 1) / bs)
+        if not blockNumbers:
+            data = self.table.read(
+                colNumbers + self._schema.indicatorColumns(colNumbers),
+                start, stop)
+            return self._formatColumns(
+                colNumbers, data.columns, result, subIndices)
+
+        blocks = {}
+        missing = []
+        for b in blockNumbers:
+            missing.append([])
+            for c in colNumbers:
+                a = cache.get((c, b))
+                if a is None:
+                    missing[-1].append(c)
+                else:
+                    blocks[(c, b)] = a
+
+        i = 0
+        while i < len(blockNumbers):
+            cols = missing[i]
+            j = i + 1
+            while j < len(blockNumbers) and missing[j] == cols:
+                j += 1
+            if cols:
+                p = blockNumbers[i] * bs
+                q = min(blockNumbers[j - 1] * bs + bs, cache.nrows)
+                data = self.table.read(
+                    cols + self._schema.indicatorColumns(cols), p, q)
+                arrays = self._formatColumns(cols, data.columns, NDARRAY)
+                for (c, a) in izip(cols, arrays):
+                    for b in blockNumbers[i:j]:
+                        r = slice(b * bs - p, min(b * bs + bs, q) - p)
+                        block = FeatureArray(a.name, a.values[r].copy(),
+                                             a.valid[r].copy())
+                        blocks[(c, b)] = block
+                        cache.put((c, b), block)
+            i = j
+
+        offset = start - blockNumbers[0] * bs
+        rows = slice(offset, offset + stop - start)
+        if subIndices is None:
+            subIndices = [None] * len(colNumbers)
+        columns = []
+        for (c, s) in izip(colNumbers, subIndices):
+            parts = [blocks[(c, b)] for b in blockNumbers]
+            values = numpy.concatenate([x.values for x in parts])[rows]
+            valid = numpy.concatenate([x.valid for x in parts])[rows]
+            if s is not None and values.ndim == 2:
+                values = values[:, s]
+            a = FeatureArray(parts[0].name, values, valid)
+            if result == NDARRAY:
+                columns.append(a)
+            elif result == MASKED:
+                columns.append(a.masked())
+            else:
+                col = deepcopy(self._schema.headers[c])
+                null = [] if values.ndim == 2 else None
+                col.values = [x if y else null for (x, y) in
+                              izip(values.tolist(), valid)]
+                columns.append(col)
+        return columns
+
+
+    def _toFeatureArray(self, col, valid):
+        """
+        Internal helper method, converts a data column and its validity
+        into a FeatureArray
+        @param col The data column
+        @param valid The values of the indicator column
+        @return a FeatureArray
+        """
+        valid = numpy.asarray(valid, dtype=bool)
+        if isinstance(col, DoubleArrayColumn):
+            values = numpy.asarray(col.values, dtype=numpy.float64)
+            values = values.reshape(len(valid), col.size)
+        elif isinstance(col, LongArrayColumn):
+            values = numpy.asarray(col.values, dtype=numpy.int64)
+            values = values.reshape(len(valid), col.size)
+        elif isinstance(col, LongColumn):
+            values = numpy.asarray(col.values, dtype=numpy.int64)
+        else:
+            values = numpy.asarray(col.values)
+        return FeatureArray(col.name, values, valid)
+
+
+    def _checkResultFormat(self, result):
+        """
+        Checks the requested result format is supported
+        @param result The result format
+        """
+        if result not in (COLUMNS, NDARRAY, MASKED):
+            raise TableConnectionError("Invalid result format: %s" % result)
 
 
     def _checkColNumbers(self, colNumbers):
@@ -485,9 +1588,150 @@ class FeatureTableConnection(TableConnection):
         @return The number of data columns (including the ID column if
         requested) but excluding the boolean indicator columns
         """
-        nCols = len(self.table.getHeaders()) / 2
+        nCols = self._getSchema().nCols
         invalid = filter(lambda x: x >= nCols, colNumbers)
         if len(invalid) > 0:
             raise TableConnectionError("Invalid column index: %s" % invalid)
 
         return nCols
+
+
+    def _updateIdIndex(self):
+        """
+        Internal helper method, brings the id index up to date with the
+        number of rows in the table. If the only rows added since the index
+        was last updated were added by this connection their ids are indexed
+        directly, otherwise the new rows are read from the table.
+        """
+        nrows = self.getNumberOfRows()
+        if self._idIndex is None:
+            self._idIndex = {}
+            self._idIndexRows = 0
+            self._idPending = []
+
+        pending = self._idPending
+        self._idPending = []
+        if nrows == self._idIndexRows:
+            return
+
+        if nrows == self._idIndexRows + sum(len(ids) for ids in pending):
+            for ids in pending:
+                self._indexIds(ids, self._idIndexRows)
+                self._idIndexRows += len(ids)
+        else:
+            for (p, data) in self.iterRead(
+                [0], self._idIndexRows, nrows, self.idIndexChunk):
+                self._indexIds(data.columns[0].values, p)
+            self._idIndexRows = nrows
+
+
+    def _indexIds(self, ids, start):
+        """
+        Internal helper method, adds a block of consecutive rows to the id
+        index, later rows replace earlier rows with the same id
+        @param ids The ids
+        @param start The row index of the first id
+        """
+        self._idIndex.update(izip(ids, xrange(start, start + len(ids))))
+
+
+    def _getZoneMap(self):
+        """
+        Internal helper method, returns the zone map of the open table if
+        zone maps are enabled on this connection
+        @return a ZoneMap, or None if the table does not have one or zone
+        maps are not enabled
+        """
+        if not self._zoneMapEnabled:
+            return None
+        return self._findZoneMap()
+
+
+    def _findZoneMap(self):
+        """
+        Internal helper method, returns the zone map of the open table,
+        looking for its companion table the first time
+        @return a ZoneMap, or None if the table does not have one
+        """
+        if not self._zoneMapChecked:
+            from ZoneMap import ZoneMap
+            if not self.table:
+                raise TableConnectionError('No table is open')
+            schema = self._getSchema()
+            name = ZoneMap.companionName(self.table.getOriginalFile())
+            ofiles = list(self.conn.getObjects(
+                "OriginalFile", attributes = {'name': name}))
+            if len(ofiles) > 1:
+                raise TableConnectionError(
+                    'Multiple zone maps with name:%s found' % name)
+            if ofiles:
+                self._zoneMap = ZoneMap.open(
+                    self.res, ofiles[0]._obj, schema.names[:schema.nCols])
+            self._zoneMapChecked = True
+        return self._zoneMap
+
+
+    def _updateZoneMap(self, added = None):
+        """
+        Internal helper method, brings the zone map up to date with the
+        rows added to the table. Rows which have just been added by this
+        connection are summarised directly, and the number of rows in the
+        table is only checked when they complete a block. If any rows have
+        been added by other connections the unsummarised rows are read
+        from the table instead.
+        @param added FeatureArrays for all data columns of the rows which
+        have just been added by this connection, or None
+        """
+        zoneMap = self._zoneMap
+        if added:
+            n = len(added[0].valid)
+            if not zoneMap.completesBlock(n):
+                zoneMap.add(added)
+                return
+            nrows = self.getNumberOfRows()
+            if nrows == zoneMap.summarisedRows() + n:
+                if zoneMap.add(added):
+                    return
+            else:
+                # The incomplete block may include rows in the wrong place
+                zoneMap.resetTail()
+        else:
+            nrows = self.getNumberOfRows()
+
+        colNumbers = range(self._schema.nCols)
+        while zoneMap.summarisedRows() < nrows:
+            for (p, arrays) in self.iterChunks(
+                colNumbers, zoneMap.summarisedRows(), nrows,
+                zoneMap.blockSize, NDARRAY):
+                if not zoneMap.add(arrays):
+                    # Another connection has added blocks, start again from
+                    # the new position
+                    break
+
+
+    def _resetTableCaches(self):
+        """
+        Internal helper method, discards all cached information about the
+        table
+        """
+        self._schema = None
+        self._idIndex = None
+        self._idIndexRows = 0
+        self._idPending = []
+        self._zoneMap = None
+        self._zoneMapChecked = False
+        if self._blockCache:
+            self._blockCache.clear()
+
+
+    def _getSchema(self):
+        """
+        Internal helper method, returns the cached schema of the open table,
+        fetching the headers if they have not already been cached
+        @return a FeatureTableSchema
+        """
+        if self._schema is None:
+            if not self.table:
+                raise TableConnectionError('No table is open')
+            self._schema = FeatureTableSchema(self.table.getHeaders())
+        return self._schema
@@ -0,0 +1,228 @@
+#
+#
+from contextlib import contextmanager
+import threading
+import time
+from TableConnection import TableConnectionError, FeatureTableConnection
+
+
+class TableConnectionPool(object):
+    """
+    A thread-safe pool of connections to a single table.
+
+    Each connection has its own session and an open handle to the table,
+    and is used by one thread at a time. Connections are created on demand
+    up to maxConnections, returned connections are kept open for reuse
+    (sessions are kept alive by the client keep-alive) and closed once they
+    have been idle for longer than idleTimeout seconds. Connections are
+    checked before being handed out, and replaced if the check fails.
+
+    Usage:
+        pool = TableConnectionPool(user, passwd, tableName='/test.h5')
+        with pool.connection() as tc:
+            tc.readArray(...)
+    """
+
+    def __init__(self, user = None, passwd = None, host = 'localhost',
+                 tableName = None, tableId = None, maxConnections = 4,
+                 idleTimeout = 300, connectionClass = FeatureTableConnection,
+                 localDir = None, sinks = None):
+        """
+        @param user Username
+        @param passwd Password
+        @param host The server hostname
+        @param tableName The name of the table file
+        @param tableId The OriginalFile ID of the table file
+        @param maxConnections The maximum number of open connections
+        @param idleTimeout Close connections which have not been used for this
+        many seconds
+        @param connectionClass The TableConnection class to be used
+        @param localDir Use the local HDF5 backend in this directory instead
+        of a server, see TableConnection
+        @param sinks An optional list of instrumentation sinks shared by all
+        connections, see TableConnection
+        """
+        self.user = user
+        self.passwd = passwd
+        self.host = host
+        self.tableName = tableName
+        self.tableId = tableId
+        self.maxConnections = maxConnections
+        self.idleTimeout = idleTimeout
+        self.connectionClass = connectionClass
+        self.localDir = localDir
+        self.sinks = sinks
+
+        self._cond = threading.Condition()
+        # (connection, last used time), most recently used last
+        self._idle = []
+        self._size = 0
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def acquire(self, timeout = None):
+        """
+        Get a connection with an open table for the exclusive use of the
+        calling thread, waiting if maxConnections are already in use
+        @param timeout The maximum number of seconds to wait, or None to wait
+        indefinitely
+        @return a connection, which must be returned with release()
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while True:
+            tc = None
+            expired = []
+            try:
+                with self._cond:
+                    while True:
+                        if self._closed:
+                            raise TableConnectionError('Pool is closed')
+                        expired.extend(self._removeExpired())
+                        if self._idle:
+                            tc = self._idle.pop()[0]
+                            break
+                        if self._size < self.maxConnections:
+                            self._size += 1
+                            break
+                        if timeout is None:
+                            self._cond.wait()
+                        else:
+                            remaining = deadline - time.time()
+                            if remaining <= 0:
+                                raise TableConnectionError(
+                                    'Timed out waiting for a connection')
+                            self._cond.wait(remaining)
+            finally:
+                self._closeAll(expired)
+
+            if tc is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    self._discarded()
+                    raise
+            if self._isHealthy(tc):
+                return tc
+            self._closeAll([tc])
+            self._discarded()
+
+    def release(self, tc, discard = False):
+        """
+        Return a connection to the pool
+        @param tc A connection obtained from acquire()
+        @param discard If True close the connection instead of keeping it
+        for reuse
+        """
+        with self._cond:
+            if not (discard or self._closed):
+                self._idle.append((tc, time.time()))
+                self._cond.notify()
+                return
+        self._closeAll([tc])
+        self._discarded()
+
+    @contextmanager
+    def connection(self, timeout = None):
+        """
+        Context manager which acquires a connection and releases it when done
+        @param timeout See acquire()
+        """
+        tc = self.acquire(timeout)
+        try:
+            yield tc
+        finally:
+            self.release(tc)
+
+    def evictIdle(self):
+        """
+        Close all connections which have been idle for longer than
+        idleTimeout
+        """
+        with self._cond:
+            expired = self._removeExpired()
+        self._closeAll(expired)
+
+    def close(self):
+        """
+        Close all idle connections, connections which are in use will be
+        closed when they are released
+        """
+        with self._cond:
+            self._closed = True
+            idle = [tc for (tc, t) in self._idle]
+            self._idle = []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        self._closeAll(idle)
+
+    def size(self):
+        """
+        @return a 2-tuple (open connections, idle connections)
+        """
+        with self._cond:
+            return self._size, len(self._idle)
+
+    def _connect(self):
+        """
+        Internal helper method, creates a new connection and opens the table
+        """
+        tc = self.connectionClass(self.user, self.passwd, self.host,
+                                  tableName=self.tableName,
+                                  localDir=self.localDir,
+                                  sinks=self.sinks)
+        try:
+            tc.openTable(tableId=self.tableId, tableName=self.tableName)
+        except Exception:
+            tc.close()
+            raise
+        return tc
+
+    def _isHealthy(self, tc):
+        """
+        Internal helper method, checks the session and table are still usable
+        """
+        try:
+            tc.table.getNumberOfRows()
+            return True
+        except Exception:
+            return False
+
+    def _removeExpired(self):
+        """
+        Internal helper method, removes expired connections from the idle
+        list, must be called with the lock held
+        @return the expired connections, which should be closed after
+        releasing the lock
+        """
+        oldest = time.time() - self.idleTimeout
+        expired = [tc for (tc, t) in self._idle if t < oldest]
+        if expired:
+            self._idle = [(tc, t) for (tc, t) in self._idle if t >= oldest]
+            self._size -= len(expired)
+        return expired
+
+    def _discarded(self):
+        """
+        Internal helper method, frees the slot of a connection which was
+        not returned to the idle list
+        """
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _closeAll(self, connections):
+        """
+        Internal helper method, closes connections ignoring any errors
+        """
+        for tc in connections:
+            try:
+                tc.close()
+            except Exception:
+                pass
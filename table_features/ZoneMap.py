@@ -0,0 +1,351 @@
+#
+#
+import logging
+import numpy
+from omero.grid import LongColumn, DoubleColumn
+from omero.rtypes import unwrap
+from TableConnection import TableConnectionError
+
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+class ZoneMap(object):
+    """
+    A block-level summary index of a feature table, used to skip blocks of
+    rows which cannot match a query.
+
+    The rows of the feature table are divided into fixed blocks of blockSize
+    rows. For each complete block and each data column (including the id
+    column) the minimum and maximum of all array elements in valid rows,
+    and the number of null rows, are stored in a companion table with one
+    row per block. OMERO.tables are append-only so the last incomplete block
+    is only summarised in memory, and is always scanned by queries.
+
+    The companion table is named after the OriginalFile name and id of the
+    feature table, see companionName(). It is maintained by the
+    FeatureTableConnections which have enabled it and write rows, where
+    possible from the rows they wrote, otherwise new rows are read back
+    from the feature table. Each block records its first row, so if two
+    connections append the same block the duplicate is skipped when the
+    companion table is read.
+    """
+
+    rowsName = '_rows'
+    startName = '_start'
+    minPrefix = '_min_'
+    maxPrefix = '_max_'
+    nullsPrefix = '_nulls_'
+    descriptionFormat = 'blockSize:%d'
+
+    def __init__(self, table, names, blockSize):
+        """
+        @param table A handle to the companion table
+        @param names The names of the data columns of the feature table
+        @param blockSize The number of rows in each block
+        """
+        self.table = table
+        self.names = names
+        self.blockSize = blockSize
+
+        self.rows = numpy.zeros(0, dtype=numpy.int64)
+        self.min = dict((n, numpy.zeros(0)) for n in names)
+        self.max = dict((n, numpy.zeros(0)) for n in names)
+        self.nulls = dict((n, numpy.zeros(0, dtype=numpy.int64))
+                          for n in names)
+        # The number of companion table rows which have been read
+        self._companionRows = 0
+        self._colNumbers = None
+        self.resetTail()
+
+    @classmethod
+    def companionName(cls, ofile):
+        """
+        @param ofile The OriginalFile of the feature table
+        @return the name of the companion table
+        """
+        return '%s.zonemap-%d' % (unwrap(ofile.name), unwrap(ofile.id))
+
+    @classmethod
+    def headers(cls, names, blockSize):
+        """
+        @return the columns of a new companion table
+        """
+        cols = [LongColumn(cls.rowsName, cls.descriptionFormat % blockSize),
+                LongColumn(cls.startName)]
+        for n in names:
+            cols.append(DoubleColumn(cls.minPrefix + n))
+            cols.append(DoubleColumn(cls.maxPrefix + n))
+            cols.append(LongColumn(cls.nullsPrefix + n))
+        return cols
+
+    @classmethod
+    def create(cls, res, rid, ofile, names, blockSize):
+        """
+        Create a new empty companion table
+        @param res The SharedResources (or local) service
+        @param rid The repository id
+        @param ofile The OriginalFile of the feature table
+        @param names The names of the data columns of the feature table
+        @param blockSize The number of rows in each block
+        @return a ZoneMap
+        """
+        table = res.newTable(rid, cls.companionName(ofile))
+        try:
+            table.initialize(cls.headers(names, blockSize))
+        except Exception:
+            table.delete()
+            raise
+        return cls(table, names, blockSize)
+
+    @classmethod
+    def open(cls, res, companion, names):
+        """
+        Open an existing companion table and read all block summaries
+        @param res The SharedResources (or local) service
+        @param companion The OriginalFile of the companion table
+        @param names The names of the data columns of the feature table
+        @return a ZoneMap
+        """
+        table = res.openTable(companion)
+        try:
+            headers = table.getHeaders()
+            try:
+                blockSize = int(headers[0].description.split(':')[1])
+            except (IndexError, ValueError):
+                raise TableConnectionError(
+                    'Invalid zone map: %s' % headers[0].description)
+            zm = cls(table, names, blockSize)
+            zm.reload()
+        except Exception:
+            table.close()
+            raise
+        return zm
+
+    def reload(self):
+        """
+        Read all block summaries from the companion table, and discard the
+        in-memory summary of the incomplete block
+        """
+        self.rows = numpy.zeros(0, dtype=numpy.int64)
+        for n in self.names:
+            self.min[n] = numpy.zeros(0)
+            self.max[n] = numpy.zeros(0)
+            self.nulls[n] = numpy.zeros(0, dtype=numpy.int64)
+        self._companionRows = 0
+        self.resetTail()
+        self.refresh()
+
+    def refresh(self):
+        """
+        Read any block summaries which have been appended to the companion
+        table since it was last read, including by other connections.
+        Blocks which duplicate a block which has already been read are
+        skipped, and the in-memory summary of rows in the new blocks is
+        discarded.
+        """
+        nBlocks = self.table.getNumberOfRows()
+        if nBlocks == self._companionRows:
+            return
+        if nBlocks < self._companionRows:
+            raise TableConnectionError(
+                'Zone map has %d blocks, expected at least %d' %
+                (nBlocks, self._companionRows))
+
+        columns = self.table.read(
+            self._columnNumbers(), self._companionRows, nBlocks).columns
+        self._companionRows = nBlocks
+        keep = []
+        next = self.indexedRows()
+        for (i, start) in enumerate(columns[1].values):
+            if start == next:
+                keep.append(i)
+                next += self.blockSize
+            elif start > next:
+                raise TableConnectionError(
+                    'Zone map is missing the block at row %d' % next)
+        if len(keep) < len(columns[1].values):
+            log.info('Skipped %d duplicate zone map blocks',
+                     len(columns[1].values) - len(keep))
+
+        def append(a, col, dtype):
+            return numpy.concatenate(
+                [a, numpy.asarray(col.values, dtype=dtype)[keep]])
+
+        indexed = self.indexedRows()
+        self.rows = append(self.rows, columns[0], numpy.int64)
+        for (i, n) in enumerate(self.names):
+            self.min[n] = append(self.min[n], columns[3 * i + 2],
+                                 numpy.float64)
+            self.max[n] = append(self.max[n], columns[3 * i + 3],
+                                 numpy.float64)
+            self.nulls[n] = append(self.nulls[n], columns[3 * i + 4],
+                                   numpy.int64)
+        self._dropTail(self.indexedRows() - indexed)
+
+    def indexedRows(self):
+        """
+        @return the number of feature table rows in complete blocks
+        """
+        return len(self.rows) * self.blockSize
+
+    def summarisedRows(self):
+        """
+        @return the number of feature table rows which have been summarised,
+        including the incomplete block
+        """
+        return self.indexedRows() + self._tailRows
+
+    def resetTail(self):
+        """
+        Discard the in-memory summary of the incomplete block
+        """
+        self._tail = []
+        self._tailRows = 0
+
+    def completesBlock(self, n):
+        """
+        @param n A number of rows
+        @return True if adding n rows would complete a block
+        """
+        return self._tailRows + n >= self.blockSize
+
+    def add(self, arrays):
+        """
+        Summarise rows which follow the already summarised rows, and append
+        any completed blocks to the companion table
+        @param arrays A list of FeatureArrays for every data column in the
+        same order as names
+        @return True if the rows were added, False if another connection
+        has appended blocks beyond these rows to the companion table, in
+        which case rows must be added again from summarisedRows()
+        """
+        if not arrays or not len(arrays[0].valid):
+            return True
+        summary = []
+        for a in arrays:
+            values = numpy.asarray(a.values, dtype=numpy.float64)
+            if values.ndim == 2:
+                if values.shape[1]:
+                    lo = numpy.fmin.reduce(values, axis=1)
+                    hi = numpy.fmax.reduce(values, axis=1)
+                else:
+                    lo = hi = numpy.repeat(numpy.nan, values.shape[0])
+            else:
+                lo = hi = values
+            valid = numpy.asarray(a.valid, dtype=bool)
+            summary.append((numpy.where(valid, lo, numpy.nan),
+                            numpy.where(valid, hi, numpy.nan), valid))
+        self._tail.append(summary)
+        self._tailRows += len(arrays[0].valid)
+        expected = self.summarisedRows()
+
+        if self._tailRows >= self.blockSize:
+            self._flushBlocks()
+        return self.summarisedRows() == expected
+
+    def candidateRanges(self, predicate, start, stop):
+        """
+        Find the ranges of rows which may contain rows matching a predicate
+        @param predicate A FeatureQuery.Predicate
+        @param start The first row
+        @param stop The last + 1 row
+        @return a list of (start, stop) row ranges
+        """
+        bs = self.blockSize
+        nBlocks = len(self.rows)
+        mayMatch = predicate.evaluateBlocks(self)[0]
+        ranges = []
+
+        def addRange(p, q):
+            if p >= q:
+                return
+            if ranges and ranges[-1][1] == p:
+                ranges[-1] = (ranges[-1][0], q)
+            else:
+                ranges.append((p, q))
+
+        first = start / bs
+        last = min(nBlocks, (stop + bs - 1) / bs)
+        for b in numpy.flatnonzero(mayMatch[first:last]) + first:
+            addRange(max(start, b * bs), min(stop, (b + 1) * bs))
+        # Rows which are not in a complete block
+        addRange(max(start, nBlocks * bs), stop)
+        return ranges
+
+    def close(self):
+        if self.table:
+            self.table.close()
+            self.table = None
+
+    def delete(self):
+        if self.table:
+            self.table.delete()
+            self.table = None
+
+    def _columnNumbers(self):
+        """
+        Internal helper method, returns the companion table columns which
+        are read, checking they match the feature table
+        """
+        if self._colNumbers is None:
+            headers = self.table.getHeaders()
+            index = dict((h.name, i) for (i, h) in enumerate(headers))
+            try:
+                self._colNumbers = [
+                    index[self.rowsName], index[self.startName]] + [
+                    index[p + n] for n in self.names for p in
+                    (self.minPrefix, self.maxPrefix, self.nullsPrefix)]
+            except KeyError as e:
+                raise TableConnectionError(
+                    'Zone map does not match table, missing column: %s' %
+                    e.args[0])
+        return self._colNumbers
+
+    def _dropTail(self, n):
+        """
+        Internal helper method, discards the in-memory summary of the first
+        n rows of the incomplete block
+        """
+        if n >= self._tailRows:
+            self.resetTail()
+        elif n > 0:
+            tail = []
+            for i in xrange(len(self.names)):
+                tail.append(tuple(
+                        numpy.concatenate([s[i][j] for s in self._tail])[n:]
+                        for j in xrange(3)))
+            self._tail = [tail]
+            self._tailRows -= n
+
+    def _flushBlocks(self):
+        """
+        Internal helper method, moves complete blocks from the in-memory
+        summary to the companion table. The companion table is read first
+        in case another connection has already appended the blocks, and
+        afterwards to load the appended blocks.
+        """
+        self.refresh()
+        nBlocks = self._tailRows / self.blockSize
+        if not nBlocks:
+            return
+        nRows = nBlocks * self.blockSize
+        shape = (nBlocks, self.blockSize)
+        first = self.indexedRows()
+
+        cols = self.table.getHeaders()
+        cols[0].values = [self.blockSize] * nBlocks
+        cols[1].values = range(first, first + nRows, self.blockSize)
+        for (i, n) in enumerate(self.names):
+            lo = numpy.concatenate([s[i][0] for s in self._tail])
+            hi = numpy.concatenate([s[i][1] for s in self._tail])
+            valid = numpy.concatenate([s[i][2] for s in self._tail])
+            bmin = numpy.fmin.reduce(lo[:nRows].reshape(shape), axis=1)
+            bmax = numpy.fmax.reduce(hi[:nRows].reshape(shape), axis=1)
+            bnulls = self.blockSize - valid[:nRows].reshape(shape).sum(axis=1)
+            cols[3 * i + 2].values = bmin.tolist()
+            cols[3 * i + 3].values = bmax.tolist()
+            cols[3 * i + 4].values = bnulls.tolist()
+        self.table.addData(cols)
+        self.refresh()
@@ -1,13 +1,29 @@
 from TableConnection import *
+import os
+import shutil
+import tempfile
 import unittest
 
+# Tests are run against the local HDF5 backend unless TEST_OMERO_HOST is set
+# to the hostname of an OMERO server with a test1/test1 user
+host = os.environ.get('TEST_OMERO_HOST')
+
+def connect(localDir):
+    user = 'test1'
+    passwd = 'test1'
+    tableName = '/test.h5'
+    if host:
+        return FeatureTableConnection(user, passwd, host, tableName = tableName)
+    return FeatureTableConnection(tableName = tableName, localDir = localDir)
+
+
 class TestFeatureTableConnection(unittest.TestCase):
 
+    layout = LAYOUT_BOOL
+
     def setUp(self):
-        user = 'test1'
-        passwd = 'test1'
-        tableName = '/test.h5'
-        self.tc = FeatureTableConnection(user, passwd, tableName = tableName)
+        self.localDir = None if host else tempfile.mkdtemp()
+        self.tc = connect(self.localDir)
 
     def tearDown(self):
         try:
@@ -15,11 +31,13 @@ class TestFeatureTableConnection(unittest.TestCase):
             pass
         finally:
             self.tc.close()
+            if self.localDir:
+                shutil.rmtree(self.localDir)
 
     def createNewTable(self):
         idcolName = 'id'
         colDescriptions = [('da1', 2), ('da2', 3), ('da3', 4)]
-        self.tc.createNewTable(idcolName, colDescriptions)
+        self.tc.createNewTable(idcolName, colDescriptions, self.layout)
 
     def populateTable(self):
         cols = self.tc.getHeaders()
@@ -43,6 +61,39 @@ class TestFeatureTableConnection(unittest.TestCase):
         tableId2 = self.tc.tableId
         self.assertEquals(tableId1, tableId2)
 
+        self.tc.deleteTable()
+        self.assertIsNone(self.tc.tableId)
+        self.assertRaises(TableConnectionError, self.tc.openTable, tableId1)
+
+
+    def testSchemaCache(self):
+        from Instrumentation import MemorySink
+        stats = MemorySink()
+        self.tc.instrumentation.addSink(stats)
+        self.createNewTable()
+        tableId = self.tc.tableId
+
+        def getHeadersCount():
+            return stats.snapshot().get('getHeaders', {}).get('count', 0)
+
+        # The headers are fetched once when the table is created or opened
+        stats.reset()
+        self.populateTable()
+        self.tc.readArray(range(4), 0, 2)
+        self.tc.readSubArray({1: [0]}, 0, 2)
+        self.populateTable()
+        self.assertEquals(getHeadersCount(), 0)
+
+        self.tc.closeTable()
+        self.assertRaises(TableConnectionError, self.tc.getHeaders)
+        stats.reset()
+        self.tc.openTable(tableId)
+        for n in xrange(3):
+            self.tc.readArray(range(4), 0, 2)
+            self.populateTable()
+        self.assertEquals(getHeadersCount(), 1)
+        self.assertEquals(self.tc.getNumberOfRows(), 10)
+
 
     def testIsValid(self):
         self.createNewTable()
@@ -86,6 +137,26 @@ class TestFeatureTableConnection(unittest.TestCase):
             cols[3].values,
             [[0.5, 0.25, 0.125, 0.0625], [], [], [], []])
 
+    def testAddDataInvalid(self):
+        import warnings
+        self.createNewTable()
+        cols = self.tc.getHeaders()[:2]
+        cols[0].values = [1, 2]
+        cols[1].values = [[1., 2.], [3.]]
+        self.assertRaises(TableConnectionError, self.tc.addPartialData, cols)
+        cols[1].values = [[1., 2.]]
+        self.assertRaises(TableConnectionError, self.tc.addPartialData, cols)
+        self.assertRaises(TableConnectionError, self.tc.addPartialData,
+                          cols[1:])
+        self.assertEquals(self.tc.getNumberOfRows(), 0)
+
+        cols[1].values = [[1., 2.], []]
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            self.tc.addPartialData(cols, copy=False)
+        self.assertEquals([x.category for x in w], [DeprecationWarning])
+        self.assertEquals(self.tc.isValid([1], 0, 2)[0].values, [True, False])
+
 
     def testGetRowId(self):
         self.createNewTable()
@@ -95,6 +166,86 @@ class TestFeatureTableConnection(unittest.TestCase):
         self.assertEquals(idx, [1])
 
 
+    def testGetRowIds(self):
+        from Instrumentation import MemorySink
+        stats = MemorySink()
+        self.tc.instrumentation.addSink(stats)
+        self.createNewTable()
+        self.populateTable()
+
+        def reads():
+            return stats.snapshot().get('read', {}).get('count', 0)
+
+        self.assertEquals(self.tc.getRowIds([2, 1, 3]), [1, 0, None])
+        self.assertEquals(reads(), 1)
+
+        # Rows added by this connection are indexed without reading them
+        self.tc.addArrays({'id': [3, 1]})
+        self.assertEquals(self.tc.getRowIds([2, 1, 3]), [1, 3, 2])
+        self.assertEquals(reads(), 1)
+
+        # Rows added by another connection are read
+        cols = self.tc.getHeaders()[:1]
+        cols[0].values = [2]
+        other = connect(self.localDir)
+        try:
+            other.openTable(self.tc.tableId)
+            other.addPartialData(cols)
+        finally:
+            other.close()
+        self.assertEquals(self.tc.getRowIds([2, 1, 3]), [4, 3, 2])
+        self.assertEquals(self.tc.getRowId(4), None)
+        self.assertEquals(reads(), 2)
+
+
+    def testGetRowIdsReusedColumns(self):
+        self.createNewTable()
+        self.assertEquals(self.tc.getRowIds([10]), [None])
+
+        # The caller may reuse the same column between writes
+        cols = self.tc.getHeaders()[:1]
+        ids = [10, 11]
+        cols[0].values = ids
+        self.tc.addPartialData(cols)
+        ids[:] = [20, 21]
+        self.tc.addPartialData(cols)
+        self.assertEquals(self.tc.getRowIds([10, 11, 20, 21]), [0, 1, 2, 3])
+
+
+    def testGetWhereList(self):
+        from omero.rtypes import rlong
+        from Instrumentation import MemorySink
+        stats = MemorySink()
+        self.tc.instrumentation.addSink(stats)
+        self.createNewTable()
+        self.populateTable()
+        self.tc.addArrays({'id': [3, 4]})
+
+        self.assertEquals(self.tc.getWhereList('(id > 1)'), [1, 2, 3])
+        self.assertEquals(self.tc.getWhereList('(id > 1)', start=2), [2, 3])
+        self.assertEquals(self.tc.getWhereList('(id >= x)', {'x': rlong(3)},
+                                               stop=3), [2])
+
+        # Only the new rows are searched
+        self.tc.addArrays({'id': [5, 1]})
+        stats.reset()
+        self.assertEquals(self.tc.getWhereList('(id > 1)'), [1, 2, 3, 4])
+        self.assertEquals(self.tc.getWhereList('(id > 1)', stop=3), [1, 2])
+        calls = stats.snapshot()['getWhereList']
+        self.assertEquals((calls['count'], calls['rows']), (1, 1))
+        self.assertEquals(self.tc.getWhereList('(id >= x)', {'x': rlong(3)}),
+                          [2, 3, 4])
+        self.assertEquals(self.tc.getWhereList('(id == 1)', start=5), [5])
+
+        # Cached results are discarded when the table is closed
+        tableId = self.tc.tableId
+        self.tc.closeTable()
+        self.tc.openTable(tableId)
+        stats.reset()
+        self.assertEquals(self.tc.getWhereList('(id > 1)'), [1, 2, 3, 4])
+        self.assertEquals(stats.snapshot()['getWhereList']['rows'], 4)
+
+
     def testReadSubArray(self):
         self.createNewTable()
         self.populateTable()
@@ -111,6 +262,556 @@ class TestFeatureTableConnection(unittest.TestCase):
         self.assertEquals(colMap['da3'].values, [[0.5, 0.0625], []])
 
 
+    def testReadArrayNdarray(self):
+        self.createNewTable()
+        self.populateTable()
+        cols = self.tc.readArray(range(4), 0, 2, result=NDARRAY)
+
+        self.assertEquals(cols[0].values.tolist(), [1, 2])
+        self.assertEquals(cols[1].values.tolist(), [[10., 20.], [30., 40.]])
+        self.assertEquals(cols[2].values.shape, (2, 3))
+        self.assertEquals(cols[2].valid.tolist(), [False, True])
+        self.assertEquals(cols[3].valid.tolist(), [True, False])
+        self.assertEquals(cols[3].values[0].tolist(), [0.5, 0.25, 0.125, 0.0625])
+
+
+    def testReadSubArrayMasked(self):
+        self.createNewTable()
+        self.populateTable()
+
+        colArrayNumbers = {3:[0, 3], 2:[2]}
+        cols = self.tc.readSubArray(colArrayNumbers, 0, 2, result=MASKED)
+        colMap = dict(zip(colArrayNumbers.keys(), cols))
+
+        self.assertEquals(colMap[2].shape, (2, 1))
+        self.assertEquals(colMap[2].mask.tolist(), [[True], [False]])
+        self.assertEquals(colMap[2][1].tolist(), [600.])
+        self.assertEquals(colMap[3].mask.tolist(), [[False, False], [True, True]])
+        self.assertEquals(colMap[3][0].tolist(), [0.5, 0.0625])
+
+
+    def testAddArrays(self):
+        self.createNewTable()
+        self.populateTable()
+        import numpy
+        da1 = numpy.array([[1., 2.], [3., 4.]])
+        da3 = numpy.arange(8.).reshape(2, 4)
+        arrays = {'id': [3, 4], 'da1': da1, 'da3': da3}
+        valid = {'da3': [False, True]}
+        self.tc.addArrays(arrays, valid)
+
+        # Inputs must not be modified
+        self.assertEquals(da3[0].tolist(), [0., 1., 2., 3.])
+
+        cols = self.tc.readArray(range(4), 2, 4)
+        self.assertEquals(cols[0].values, [3, 4])
+        self.assertEquals(cols[1].values, [[1., 2.], [3., 4.]])
+        self.assertEquals(cols[2].values, [[], []])
+        self.assertEquals(cols[3].values, [[], [4., 5., 6., 7.]])
+
+        self.assertRaises(TableConnectionError, self.tc.addArrays,
+                          {'id': [5], 'da1': [[1., 2., 3.]]})
+        self.assertRaises(TableConnectionError, self.tc.addArrays,
+                          {'da1': [[1., 2.]]})
+
+
+    def testPipelinedRead(self):
+        self.createNewTable()
+        self.populateTable()
+        cols = self.tc.getHeaders()[:1]
+        cols[0].values = [3, 4, 5]
+        self.tc.addPartialData(cols)
+
+        allCols = range(len(self.tc.table.getHeaders()))
+        expected = self.tc.chunkedRead(allCols, 0, 5, 2)
+        for prefetch in [0, 1, 3]:
+            data = self.tc.pipelinedRead(allCols, 0, 6, 2, prefetch)
+            self.assertEquals(data.rowNumbers, expected.rowNumbers)
+            for (c, e) in zip(data.columns, expected.columns):
+                self.assertEquals(c.values, e.values)
+
+        data = self.tc.pipelinedRead(range(4), 1, 4, 2, asarrays=True)
+        self.assertEquals(data.rowNumbers.tolist(), [1, 2, 3])
+        self.assertEquals(data.columns[0].values.tolist(), [2, 3, 4])
+        self.assertEquals(data.columns[1].values.shape, (3, 2))
+        self.assertEquals(data.columns[2].values[0].tolist(),
+                          [400., 500., 600.])
+
+        cols = self.tc.readArray(range(4), 0, 5, result=NDARRAY, chunk=2)
+        self.assertEquals(cols[0].values.tolist(), [1, 2, 3, 4, 5])
+        self.assertEquals(cols[2].valid.tolist(),
+                          [False, True, False, False, False])
+
+
+    def testIterChunks(self):
+        self.createNewTable()
+        self.populateTable()
+        cols = self.tc.getHeaders()[:2]
+        cols[0].values = [3, 4, 5]
+        cols[1].values = [[1., 2.], [], [5., 6.]]
+        self.tc.addPartialData(cols)
+
+        chunks = list(self.tc.iterChunks([0, 1], chunk=2))
+        self.assertEquals([p for (p, c) in chunks], [0, 2, 4])
+        self.assertEquals([c[1].values for (p, c) in chunks],
+                          [[[10., 20.], [30., 40.]], [[1., 2.], []], [[5., 6.]]])
+
+        chunks = list(self.tc.iterChunks(
+                {1: [1], 3: [0, 3]}, 1, 5, 3, result=NDARRAY, prefetch=0))
+        self.assertEquals(len(chunks), 2)
+        (p, c) = chunks[0]
+        colMap = dict((a.name, a) for a in c)
+        self.assertEquals(p, 1)
+        self.assertEquals(colMap['da1'].values.tolist(), [[40.], [2.], [0.]])
+        self.assertEquals(colMap['da1'].valid.tolist(), [True, True, False])
+        self.assertEquals(colMap['da3'].values.shape, (3, 2))
+
+
+    def testFeatureTableWriter(self):
+        from FeatureTableWriter import FeatureTableWriter
+        self.createNewTable()
+
+        with FeatureTableWriter(self.tc, maxRows=3) as w:
+            w.addRow(1, {'da1': [1., 2.]})
+            w.addRow(2, {'da2': [3., 4., 5.], 'da3': []})
+            self.assertEquals(self.tc.getNumberOfRows(), 0)
+
+            cols = self.tc.getHeaders()
+            cols = [cols[0], cols[3]]
+            cols[0].values = [3, 4]
+            cols[1].values = [[], [6., 7., 8., 9.]]
+            w.addPartialData(cols)
+            self.assertEquals(self.tc.getNumberOfRows(), 4)
+
+            w.addRow(5, {})
+            self.assertRaises(TableConnectionError, w.addRow, 6, {'x': [1.]})
+            self.assertRaises(TableConnectionError, w.addRow, 6, {'da1': [1.]})
+
+        self.assertEquals(w.rowsWritten, 5)
+        cols = self.tc.readArray(range(4), 0, 5)
+        self.assertEquals(cols[0].values, [1, 2, 3, 4, 5])
+        self.assertEquals(cols[1].values, [[1., 2.], [], [], [], []])
+        self.assertEquals(cols[2].values, [[], [3., 4., 5.], [], [], []])
+        self.assertEquals(cols[3].values, [[], [], [], [6., 7., 8., 9.], []])
+
+
+    def testQuery(self):
+        from FeatureQuery import Feature
+        self.createNewTable()
+        self.populateTable()
+        self.tc.addArrays({'id': [3, 4], 'da1': [[5., 60.], [70., 80.]],
+                           'da2': [[1., 2., 3.], [4., 5., 6.]]})
+
+        da1 = Feature('da1')
+        self.assertEquals(self.tc.query(da1.all() > 25), [1, 3])
+        self.assertEquals(self.tc.query(da1.any() < 10, chunk=1), [2])
+        self.assertEquals(self.tc.query(da1.mean() == 15), [0])
+        self.assertEquals(self.tc.query(da1[1] >= 40, count=True), 3)
+        self.assertEquals(self.tc.query(Feature('id') != 2, start=1), [2, 3])
+
+        # Comparisons on null rows are unknown
+        da2 = Feature('da2')
+        self.assertEquals(self.tc.query(da2.max() > 3), [1, 3])
+        self.assertEquals(self.tc.query(~(da2.max() > 3)), [2])
+        self.assertEquals(self.tc.query(da2.isNull()), [0])
+        self.assertEquals(
+            self.tc.query((da2.min() < 2) | Feature('da3').notNull()), [0, 2])
+        self.assertEquals(
+            self.tc.query((da2.min() < 2) & (da1.min() > 100)), [])
+
+        self.assertRaises(TableConnectionError, self.tc.query,
+                          Feature('unknown').all() > 1)
+        self.assertRaises(TableConnectionError, self.tc.query, da1 > 1)
+
+
+    def testZoneMap(self):
+        from FeatureQuery import Feature
+        self.createNewTable()
+        self.populateTable()
+        self.tc.createZoneMap(blockSize=2)
+        self.tc.addArrays({'id': [3, 4, 5], 'da1': [[5., 6.], [7., 8.],
+                                                    [90., 100.]]})
+
+        zoneMap = self.tc._getZoneMap()
+        self.assertEquals(zoneMap.rows.tolist(), [2, 2])
+        self.assertEquals(zoneMap.min['da1'].tolist(), [10., 5.])
+        self.assertEquals(zoneMap.max['da1'].tolist(), [40., 8.])
+        self.assertEquals(zoneMap.nulls['da2'].tolist(), [1, 2])
+        self.assertEquals(zoneMap.max['id'].tolist(), [2., 4.])
+
+        # The second block and the incomplete last block are read
+        pred = Feature('da1').any() < 9
+        self.assertEquals(zoneMap.candidateRanges(pred, 0, 5), [(2, 5)])
+        self.assertEquals(self.tc.query(pred), [2, 3])
+        self.assertEquals(
+            zoneMap.candidateRanges(Feature('da2').isNull(), 1, 5), [(1, 5)])
+        self.assertEquals(zoneMap.candidateRanges(
+                Feature('da2').notNull(), 0, 5), [(0, 2), (4, 5)])
+        self.assertEquals(self.tc.query(Feature('da1').min() >= 90), [4])
+
+        # Connections only use the zone map if it is enabled, and queries
+        # don't update the companion table
+        tc2 = connect(self.localDir)
+        try:
+            tc2.openTable(self.tc.tableId)
+            tc2.addArrays({'id': [6], 'da1': [[1., 2.]]})
+            self.assertEquals(tc2.query(pred), [2, 3, 5])
+            tc2.enableZoneMap()
+            self.assertEquals(tc2.query(pred), [2, 3, 5])
+            self.assertEquals(zoneMap.table.getNumberOfRows(), 2)
+
+            # Rows added by other connections are read back when a block
+            # is completed
+            tc2.addArrays({'id': [7, 8], 'da1': [[50., 60.], [70., 80.]]})
+            self.assertEquals(tc2._getZoneMap().rows.tolist(), [2, 2, 2, 2])
+        finally:
+            tc2.close()
+        self.assertEquals(self.tc.query(pred), [2, 3, 5])
+        self.assertEquals(zoneMap.min['da1'].tolist(), [10., 5., 1., 50.])
+
+        # Blocks appended more than once by concurrent writers are skipped
+        nCols = len(zoneMap.table.getHeaders())
+        duplicate = zoneMap.table.read(range(nCols), 3, 4)
+        zoneMap.table.addData(duplicate.columns)
+        zoneMap.reload()
+        self.assertEquals(zoneMap.rows.tolist(), [2, 2, 2, 2])
+        self.tc.addArrays({'id': [9, 10], 'da1': [[3., 4.], [5., 6.]]})
+        self.assertEquals(zoneMap.min['da1'].tolist(), [10., 5., 1., 50., 3.])
+        self.assertEquals(self.tc.query(pred), [2, 3, 5, 8, 9])
+
+        self.tc.deleteZoneMap()
+        self.assertEquals(self.tc._getZoneMap(), None)
+        self.assertEquals(self.tc.query(pred), [2, 3, 5, 8, 9])
+
+
+    def testBlockCache(self):
+        self.createNewTable()
+        self.populateTable()
+        self.tc.addArrays({'id': [3, 4, 5], 'da1': [[5., 6.], [7., 8.],
+                                                    [9., 10.]]})
+        uncached = self.tc.readArray([0, 1, 2], 1, 5)
+        uncachedSub = self.tc.readSubArray({1: [1], 2: [0, 2]}, 0, 4)
+
+        self.tc.enableBlockCache(blockSize=2)
+        cols = self.tc.readArray([0, 1, 2], 1, 5)
+        self.assertEquals([c.values for c in cols],
+                          [c.values for c in uncached])
+        self.assertEquals(self.tc.blockCacheStats()['misses'], 9)
+        self.assertEquals(self.tc.blockCacheStats()['hits'], 0)
+
+        # Sub-arrays are served from the cached blocks
+        cols = self.tc.readSubArray({1: [1], 2: [0, 2]}, 0, 4)
+        self.assertEquals([c.values for c in cols],
+                          [c.values for c in uncachedSub])
+        stats = self.tc.blockCacheStats()
+        self.assertEquals((stats['hits'], stats['misses']), (4, 9))
+
+        arrays = self.tc.readArray([1], 3, 5, result=NDARRAY)
+        self.assertEquals(arrays[0].values.tolist(), [[7., 8.], [9., 10.]])
+        self.assertEquals(arrays[0].valid.tolist(), [True, True])
+
+        # Writes discard the incomplete last block
+        self.tc.addArrays({'id': [6], 'da1': [[11., 12.]]})
+        cols = self.tc.readArray([1], 3, 6)
+        self.assertEquals(cols[0].values, [[7., 8.], [9., 10.], [11., 12.]])
+        stats = self.tc.blockCacheStats()
+        self.assertEquals((stats['hits'], stats['misses']), (7, 10))
+
+        # Least recently used blocks are evicted
+        self.tc.enableBlockCache(maxBytes=100, blockSize=2)
+        self.tc.readArray([1], 0, 6)
+        stats = self.tc.blockCacheStats()
+        self.assertEquals(stats['evictions'], 1)
+        self.assertEquals(stats['blocks'], 2)
+        self.assertTrue(stats['bytes'] <= 100)
+
+
+    def testExportArchive(self):
+        from FeatureArchive import readArchive
+        self.createNewTable()
+        self.populateTable()
+        self.tc.addArrays({'id': [3]})
+        tmpDir = tempfile.mkdtemp()
+        try:
+            progress = []
+            path = os.path.join(tmpDir, 'export.npz')
+            n = self.tc.exportArchive(path, chunk=2,
+                                      progress=lambda *p: progress.append(p))
+            self.assertEquals(n, 3)
+            self.assertEquals(progress, [(2, 3), (3, 3)])
+            a, v, t = readArchive(path)
+            self.assertEquals(a['id'].tolist(), [1, 2, 3])
+            self.assertEquals(a['da1'].tolist()[:2],
+                              [[10., 20.], [30., 40.]])
+            self.assertEquals(v['da2'].tolist(), [False, True, False])
+            self.assertIsNone(t)
+
+            # Interrupted after the first row, then resumed
+            path = os.path.join(tmpDir, 'export.h5')
+            self.assertEquals(self.tc.exportArchive(path, 1, 2), 1)
+            self.assertEquals(self.tc.exportArchive(path, 1, resume=True), 2)
+            a, v, t = readArchive(path)
+            self.assertEquals(a['id'].tolist(), [2, 3])
+            self.assertEquals(a['da3'].tolist()[0], [0., 0., 0., 0.])
+            self.assertEquals(v['da3'].tolist(), [False, False])
+            self.assertRaises(TableConnectionError, self.tc.exportArchive,
+                              path, 0, resume=True)
+        finally:
+            shutil.rmtree(tmpDir)
+
+
+    def testImportArchives(self):
+        import numpy
+        import tables
+        from FeatureArchive import writeArchive
+        self.createNewTable()
+        tmpDir = tempfile.mkdtemp()
+        try:
+            archive = os.path.join(tmpDir, 'a.h5')
+            writeArchive(archive, {'id': [1, 2, 3],
+                                   'da1': [[1., 2.], [3., 4.], [5., 6.]]},
+                         {'da1': [True, False, True]})
+            # A feature tree file as written by tablestest.py
+            tree = os.path.join(tmpDir, 't.h5')
+            h = tables.openFile(tree, 'w')
+            a = h.createEArray('/', 'da3', tables.Float32Atom(), (0, 4))
+            a.append([[1, 2, 3, 4], [numpy.nan] * 4])
+            h.close()
+
+            def fail(done, total):
+                raise Exception('Interrupted')
+            checkpoint = os.path.join(tmpDir, 'checkpoint')
+            self.assertRaises(Exception, self.tc.importArchives,
+                              [archive, tree], batch=2, processes=1,
+                              checkpoint=checkpoint, progress=fail)
+            self.assertEquals(self.tc.getNumberOfRows(), 2)
+
+            n = self.tc.importArchives([archive, tree], batch=2, processes=2,
+                                       checkpoint=checkpoint)
+            self.assertEquals(n, 5)
+            self.assertFalse(os.path.exists(checkpoint))
+            ids, da1, da3 = self.tc.readArray([0, 1, 3], 0, 5, NDARRAY)
+            self.assertEquals(ids.values.tolist(), [1, 2, 3, 1, 2])
+            self.assertEquals(da1.valid.tolist(),
+                              [True, False, True, False, False])
+            self.assertEquals(da1.values[2].tolist(), [5., 6.])
+            self.assertEquals(da3.valid.tolist(),
+                              [False, False, False, True, False])
+            self.assertEquals(da3.values[3].tolist(), [1., 2., 3., 4.])
+        finally:
+            shutil.rmtree(tmpDir)
+
+
+    def testInstrumentation(self):
+        from Instrumentation import MemorySink, CallbackSink
+        stats = MemorySink()
+        events = []
+        self.tc.instrumentation.addSink(stats)
+        self.tc.instrumentation.addSink(CallbackSink(events.append))
+
+        self.createNewTable()
+        self.populateTable()
+        self.tc.readArray([0, 1], 0, 2)
+        s = stats.snapshot()
+        self.assertEquals(s['newTable']['count'], 1)
+        self.assertEquals(s['addData']['count'], 1)
+        self.assertEquals(s['addData']['rows'], 2)
+        self.assertTrue(s['addData']['bytes'] > 0)
+        self.assertEquals(s['read']['rows'], 2)
+        self.assertEquals(len(events), sum(v['count'] for v in s.values()))
+        self.assertEquals(events[0].operation, 'newTable')
+
+        # Opening by name should keep the table id
+        self.tc.closeTable()
+        stats.reset()
+        self.tc.openTable(tableName='/test.h5')
+        self.assertIsNotNone(self.tc.tableId)
+        self.assertEquals(stats.snapshot()['openTable']['count'], 1)
+
+
+    def testManyColumns(self):
+        colDescriptions = [('d%03d' % n, 1) for n in xrange(140)]
+        self.tc.createNewTable('id', colDescriptions, self.layout)
+        self.assertEquals(self.tc._schema.layout, self.layout)
+
+        arrays = dict((name, [[n], [-n]]) for (n, (name, size)) in
+                      enumerate(colDescriptions, 1))
+        arrays['id'] = [1, 2]
+        valid = dict((name, [n % 2 == 0, n % 3 == 0]) for (n, (name, size))
+                     in enumerate(colDescriptions, 1))
+        self.tc.addArrays(arrays, valid)
+
+        colNumbers = [140, 1, 63, 64, 65, 128]
+        cols = self.tc.readArray(colNumbers, 0, 2)
+        for (n, c) in zip(colNumbers, cols):
+            self.assertEquals(c.values, [[n] if n % 2 == 0 else [],
+                                         [-n] if n % 3 == 0 else []])
+
+        bcols = self.tc.isValid([0] + colNumbers, 0, 2)
+        self.assertEquals(bcols[0].values, [True, True])
+        for (n, b) in zip(colNumbers, bcols[1:]):
+            self.assertEquals(b.values, [n % 2 == 0, n % 3 == 0])
+
+
+class TestFeatureTableConnectionPacked(TestFeatureTableConnection):
+
+    layout = LAYOUT_PACKED
+
+
+class TestTableConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.localDir = None if host else tempfile.mkdtemp()
+        self.tc = connect(self.localDir)
+        self.tc.createNewTable('id', [('da1', 2)])
+
+    def tearDown(self):
+        self.tc.close()
+        if self.localDir:
+            shutil.rmtree(self.localDir)
+
+    def testAcquireRelease(self):
+        from TableConnectionPool import TableConnectionPool
+        with TableConnectionPool('test1', 'test1', host, tableName='/test.h5',
+                                 tableId=self.tc.tableId, maxConnections=2,
+                                 localDir=self.localDir) as pool:
+            tc1 = pool.acquire()
+            tc2 = pool.acquire()
+            self.assertEquals(pool.size(), (2, 0))
+            self.assertRaises(TableConnectionError, pool.acquire, 0.1)
+
+            tc2.addArrays({'id': [1, 2]})
+            pool.release(tc2)
+            with pool.connection() as tc3:
+                self.assertTrue(tc3 is tc2)
+                self.assertEquals(tc3.getRowIds([2]), [1])
+            self.assertEquals(pool.size(), (2, 1))
+
+            pool.idleTimeout = 0
+            pool.evictIdle()
+            self.assertEquals(pool.size(), (1, 0))
+            pool.release(tc1)
+
+
+class TestFeatureArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testWriteRead(self):
+        import numpy
+        from FeatureArchive import writeArchive, readArchive, archiveColumns
+        arrays = {'id': [3, 4, 5], 'b': [[1., 2.], [3., 4.], [5., 6.]],
+                  'a': [[7.], [8.], [9.]]}
+        valid = {'b': [True, False, True]}
+        ts = numpy.array(['2013-01-01T00:00:00', '2013-01-02T00:00:00',
+                          '2013-01-03T00:00:00'], dtype='datetime64[us]')
+
+        for ext in ['npz', 'h5']:
+            path = os.path.join(self.tmpDir, 'test.' + ext)
+            writeArchive(path, arrays, valid, timestamps=ts)
+            self.assertEquals(archiveColumns(path),
+                              [('id', None), ('a', 1), ('b', 2)])
+
+            a, v, t = readArchive(path, 1, 3)
+            self.assertEquals(sorted(a.keys()), ['a', 'b', 'id'])
+            self.assertEquals(a['id'].tolist(), [4, 5])
+            self.assertEquals(a['b'].tolist(), [[3., 4.], [5., 6.]])
+            self.assertEquals(v['a'].tolist(), [True, True])
+            self.assertEquals(v['b'].tolist(), [False, True])
+            self.assertEquals(t.tolist(), ts[1:].tolist())
+
+        self.assertRaises(TableConnectionError, writeArchive,
+                          os.path.join(self.tmpDir, 'test.h5'),
+                          {'id': [1], 'a': [[1.], [2.]]})
+
+    def testResumeInvalid(self):
+        import io
+        import tables
+        from FeatureArchive import ArchiveWriter, writeArchive
+        columns = [('id', None), ('a', 1)]
+        path = os.path.join(self.tmpDir, 'test.h5')
+        writeArchive(path, {'id': range(1000), 'a': [[1.]] * 1000})
+
+        # Interrupted before the header or arrays were written
+        h = tables.openFile(path, 'a')
+        h.removeNode('/', 'v0')
+        h.close()
+        self.assertRaises(TableConnectionError, ArchiveWriter, path,
+                          columns, resume=True)
+        h = tables.openFile(path, 'a')
+        del h.root._v_attrs.header
+        h.close()
+        self.assertRaises(TableConnectionError, ArchiveWriter, path,
+                          columns, resume=True)
+
+        # Truncated file
+        writeArchive(path, {'id': range(1000), 'a': [[1.]] * 1000})
+        with io.open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) / 2)
+        self.assertRaises(TableConnectionError, ArchiveWriter, path,
+                          columns, resume=True)
+
+    def testReadTree(self):
+        import numpy
+        import tables
+        from FeatureArchive import readArchive, archiveColumns, archiveRows
+        nan = numpy.nan
+        f1 = [[1., 2.], [3., 4.], [nan, nan]]
+        f2 = [[nan, nan, nan], [5., 6., 7.], [8., 9., 10.]]
+
+        # Feature tree files as written by tablestest.py in each mode
+        paths = [os.path.join(self.tmpDir, '%s.h5' % m)
+                 for m in ('tables', 'earray', 'matrix')]
+        h = tables.openFile(paths[0], 'w')
+        for (name, values) in [('f1', f1), ('f2', f2)]:
+            t = h.createTable('/g', name, dict(
+                    ('x%04d' % n, tables.Float32Col())
+                    for n in xrange(len(values[0]))), createparents=True)
+            t.append([tuple(v) for v in values])
+        h.close()
+
+        h = tables.openFile(paths[1], 'w')
+        for (name, values) in [('f1', f1), ('f2', f2)]:
+            a = h.createEArray('/g', name, tables.Float32Atom(),
+                               (0, len(values[0])), createparents=True)
+            a.append(values)
+        h.close()
+
+        h = tables.openFile(paths[2], 'w')
+        features = h.createTable('/', 'features', {
+                'path': tables.StringCol(64, pos=0),
+                'start': tables.Int32Col(pos=1),
+                'stop': tables.Int32Col(pos=2)})
+        features.append([('/g/f1', 0, 2), ('/g/f2', 2, 5)])
+        m = h.createEArray('/', 'matrix', tables.Float32Atom(), (0, 5))
+        m.append(numpy.nan_to_num(numpy.hstack([f1, f2])))
+        v = h.createEArray('/', 'valid', tables.BoolAtom(), (0, 2))
+        v.append([[True, False], [True, True], [False, True]])
+        h.close()
+
+        for path in paths:
+            self.assertEquals(archiveColumns(path),
+                              [('id', None), ('g_f1', 2), ('g_f2', 3)])
+            self.assertEquals(archiveRows(path), 3)
+            a, v, t = readArchive(path, 1, 3)
+            self.assertEquals(a['id'].tolist(), [2, 3])
+            self.assertEquals(a['g_f1'][0].tolist(), [3., 4.])
+            self.assertEquals(a['g_f2'].tolist(), [[5., 6., 7.], [8., 9., 10.]])
+            self.assertEquals(v['g_f1'].tolist(), [True, False])
+            self.assertEquals(v['g_f2'].tolist(), [True, True])
+
+        # Other layouts are rejected
+        h = tables.openFile(paths[0], 'a')
+        h.createArray('/', 'scalars', [1., 2., 3.])
+        h.close()
+        self.assertRaises(TableConnectionError, readArchive, paths[0])
+        self.assertRaises(TableConnectionError, archiveRows, paths[0])
+
+
 
 def open():
     user = 'test1'